@@ -0,0 +1,171 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Time each phase of splitrsync (list generation, split, directory tree, transfer,
+# deletion) on a synthetic tree for every combination of number of processes and split
+# algorithm. By default rsync is replaced by benchmarks/fake_rsync, which only lists and
+# reads the lists, so the overhead of splitrsync itself is measured. Results are written
+# as JSON, one file per invocation, to compare runs across changes and machines
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+
+from datetime import datetime
+from tempfile import mkdtemp
+
+import splitrsync.rsync
+
+from benchmarks.tree_gen import profiles, generate_tree, tree_stats
+from splitrsync.item_list import generate_list
+from splitrsync.parallel_rsync import RsyncSplitList, prsync, prm
+from splitrsync.progress import ProgressMonitor
+from splitrsync.split import split_rr, split_size, LPTSplit, DirAffinitySplit
+
+fake_rsync_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_rsync')
+split_algorithms = ['round_robin', 'equal_size', 'lpt', 'dir_affinity']
+# files in the destination which are not in the source, so the deletion has some work
+extraneous_dirs = 20
+extraneous_files = 100
+
+# split_rr and split_size keep their state in the function, it must be reset before
+# every run
+def _split_func(name):
+	if name == 'round_robin':
+		split_rr.next_index = 0
+		return split_rr
+	if name == 'equal_size':
+		split_size.smaller = 0
+		split_size.sizes = []
+		return split_size
+	if name == 'lpt':
+		return LPTSplit()
+	return DirAffinitySplit()
+
+def _make_extraneous(dest):
+	for d in range(extraneous_dirs):
+		dir_path = os.path.join(dest, 'extraneous-%02d' % d)
+		os.makedirs(dir_path)
+		for f in range(extraneous_files):
+			open(os.path.join(dir_path, 'f%03d' % f), 'wb').close()
+	return
+
+def _timed(timings, name, func, *args):
+	start = time.time()
+	ret = func(*args)
+	timings[name] = time.time() - start
+	return ret
+
+def run_once(source, dest, nproc, algorithm, workdir):
+	if os.path.exists(dest):
+		shutil.rmtree(dest)
+	os.makedirs(dest)
+	_make_extraneous(dest)
+	tmpdir = mkdtemp(prefix = 'run-', dir = workdir)
+	file_list = os.path.join(tmpdir, 'list')
+	delete_list = os.path.join(tmpdir, 'list-delete')
+	timings = {}
+	src = source.encode() + b'/'
+	dst = dest.encode()
+	_timed(timings, 'generate_list', generate_list, ['-a', '--delete'], src, dst, file_list, delete_list)
+	split_list = RsyncSplitList(nproc, file_list, b'\0', tmpdir, _split_func(algorithm))
+	_timed(timings, 'split', split_list.split_and_dump)
+	# prsync records the directory tree and the transfer as separate phases
+	progress = ProgressMonitor(live = False)
+	prsync(['-a'], split_list, src, dst, progress)
+	for name, p in progress.phases.items():
+		timings[name] = p['duration']
+	remover = _timed(timings, 'delete', prm, nproc, delete_list, dst)
+	shutil.rmtree(tmpdir)
+	return {
+			'processes': nproc,
+			'split_algorithm': algorithm,
+			'timings': timings,
+			'total': sum(timings.values()),
+			'list_sizes': [s[1] for s in split_list.split_stats],
+			'delete': remover.stats(),
+	}
+
+def run_benchmark(profile, scale, processes, algorithms, workdir, real_rsync = False, seed = 0, sparse = True):
+	if not real_rsync:
+		splitrsync.rsync.rsync_cmd = fake_rsync_path.encode()
+	source = os.path.join(workdir, 'source')
+	dest = os.path.join(workdir, 'dest')
+	start = time.time()
+	generate_tree(source, profile, scale, seed, sparse)
+	result = {
+			'profile': profile,
+			'scale': scale,
+			'seed': seed,
+			'tree': tree_stats(source),
+			'tree_generation_time': time.time() - start,
+			'rsync': 'rsync' if real_rsync else 'fake',
+			'host': platform.node(),
+			'cpus': os.cpu_count(),
+			'python': platform.python_version(),
+			'date': datetime.now().isoformat(),
+			'runs': [],
+	}
+	for nproc in processes:
+		for algorithm in algorithms:
+			print('Running %s with %d processes, split algorithm %s' % (profile, nproc, algorithm))
+			result['runs'].append(run_once(source, dest, nproc, algorithm, workdir))
+	return result
+
+def print_summary(result):
+	print('%s: %d files, %d dirs, %d bytes' % (result['profile'], result['tree']['files'], result['tree']['dirs'],
+			result['tree']['bytes']))
+	for run in result['runs']:
+		print('    %3d processes, %-12s %7.2fs  (%s)' % (run['processes'], run['split_algorithm'], run['total'],
+				', '.join('%s %.2fs' % (k, v) for k, v in run['timings'].items())))
+	return
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Measure the time spent in each splitrsync phase on a synthetic tree')
+	parser.add_argument('--profile', choices = profiles, default = 'mixed')
+	parser.add_argument('--scale', type = float, default = 1.0, help = 'multiply the number of files by SCALE')
+	parser.add_argument('--seed', type = int, default = 0)
+	parser.add_argument('--processes', type = int, nargs = '+', default = [1, 4, 16])
+	parser.add_argument('--split-algorithm', choices = split_algorithms, nargs = '+', default = split_algorithms)
+	parser.add_argument('--real-rsync', action = 'store_true',
+			help = 'use the real rsync instead of the fake one, files are really copied')
+	parser.add_argument('--dense', action = 'store_true',
+			help = 'write random data in the files instead of creating them sparse (huge files are always sparse)')
+	parser.add_argument('--workdir', help = 'where the trees are created (default: a temporary directory, removed at the end)')
+	parser.add_argument('--output', help = 'write the results as JSON to OUTPUT')
+	args = parser.parse_args(sys.argv[1:])
+	workdir = args.workdir
+	if workdir is None:
+		workdir = mkdtemp(prefix = 'splitrsync-bench-')
+	try:
+		result = run_benchmark(args.profile, args.scale, args.processes, args.split_algorithm, workdir,
+				args.real_rsync, args.seed, not args.dense)
+	finally:
+		if args.workdir is None:
+			shutil.rmtree(workdir)
+	print_summary(result)
+	if args.output is not None:
+		with open(args.output, 'w') as f:
+			json.dump(result, f, indent = 1)
@@ -0,0 +1,119 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Synthetic trees for benchmarking. Every profile is deterministic for a given seed and
+# scale, so results from different runs and machines can be compared
+
+import argparse
+import os
+import random
+import sys
+
+profiles = ['tiny', 'huge', 'deep', 'wide', 'mixed']
+
+def _write_file(path, size, rnd, sparse):
+	with open(path, 'wb') as f:
+		if sparse:
+			# huge files don't need real data unless we want to measure real I/O
+			f.truncate(size)
+		else:
+			f.write(rnd.getrandbits(8 * size).to_bytes(size, 'little') if size > 0 else b'')
+	return
+
+def _tiny(root, scale, rnd, sparse):
+	for d in range(int(100 * scale)):
+		dir_path = os.path.join(root, 'tiny', 'd%04d' % d)
+		os.makedirs(dir_path)
+		for f in range(100):
+			_write_file(os.path.join(dir_path, 'f%04d' % f), rnd.randint(0, 4096), rnd, sparse)
+	return
+
+def _huge(root, scale, rnd, sparse):
+	dir_path = os.path.join(root, 'huge')
+	os.makedirs(dir_path)
+	for f in range(max(1, int(4 * scale))):
+		_write_file(os.path.join(dir_path, 'h%02d' % f), rnd.randint(512, 1024) * 1024**2, rnd, True)
+	return
+
+def _deep(root, scale, rnd, sparse):
+	for t in range(max(1, int(4 * scale))):
+		dir_path = os.path.join(root, 'deep', 't%02d' % t)
+		for level in range(50):
+			dir_path = os.path.join(dir_path, 'l%02d' % level)
+			os.makedirs(dir_path)
+			for f in range(5):
+				_write_file(os.path.join(dir_path, 'f%d' % f), rnd.randint(0, 64 * 1024), rnd, sparse)
+	return
+
+def _wide(root, scale, rnd, sparse):
+	dir_path = os.path.join(root, 'wide')
+	os.makedirs(dir_path)
+	for f in range(int(20000 * scale)):
+		_write_file(os.path.join(dir_path, 'f%06d' % f), rnd.randint(0, 16 * 1024), rnd, sparse)
+	return
+
+def _mixed(root, scale, rnd, sparse):
+	_tiny(root, scale / 4, rnd, sparse)
+	_huge(root, scale / 4, rnd, sparse)
+	_deep(root, scale / 4, rnd, sparse)
+	_wide(root, scale / 4, rnd, sparse)
+	return
+
+_generators = {
+	'tiny': _tiny,
+	'huge': _huge,
+	'deep': _deep,
+	'wide': _wide,
+	'mixed': _mixed,
+}
+
+# huge files are always sparse, sparse = True makes all files sparse which is much
+# faster to generate when only metadata and scheduling are measured
+def generate_tree(root, profile, scale = 1.0, seed = 0, sparse = False):
+	if profile not in _generators:
+		raise ValueError('unknown tree profile %s, valid profiles are: %s' % (profile, ', '.join(profiles)))
+	if os.path.exists(root) and len(os.listdir(root)) > 0:
+		raise ValueError('%s exists and is not empty' % root)
+	os.makedirs(root, exist_ok = True)
+	_generators[profile](root, scale, random.Random(seed), sparse)
+	return
+
+def tree_stats(root):
+	files = 0
+	size = 0
+	dirs = 0
+	for dir_path, dir_names, file_names in os.walk(root):
+		dirs += len(dir_names)
+		for name in file_names:
+			files += 1
+			size += os.lstat(os.path.join(dir_path, name)).st_size
+	return {'files': files, 'dirs': dirs, 'bytes': size}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Generate a synthetic tree for benchmarking splitrsync')
+	parser.add_argument('--profile', choices = profiles, default = 'mixed')
+	parser.add_argument('--scale', type = float, default = 1.0, help = 'multiply the number of files by SCALE')
+	parser.add_argument('--seed', type = int, default = 0)
+	parser.add_argument('--sparse', action = 'store_true', help = 'create all files as sparse files')
+	parser.add_argument('root', help = 'directory where the tree is created, must be empty or not exist')
+	args = parser.parse_args(sys.argv[1:])
+	generate_tree(args.root, args.profile, args.scale, args.seed, args.sparse)
+	print(tree_stats(args.root))
@@ -0,0 +1,66 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Agent running on each node of a distributed transfer, started by the coordinator (see
+# distributed.py) with python -m splitrsync.agent. The first line on the standard input
+# carries the rsync options, source, destination and number of parallel rsync processes,
+# every following line a batch to sync. For every batch a line is written on the standard
+# output once rsync is done. The agent exits when the standard input is closed and all
+# batches are synced
+
+import json
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from .parallel_rsync import _rsync_files_from
+
+def _sync_batch(config, list_file_path, out, lock):
+	start = time.time()
+	reply = {'batch': list_file_path, 'ok': True, 'error': None}
+	try:
+		_rsync_files_from(config['args'], list_file_path, os.fsencode(config['source']), os.fsencode(config['dest']))
+	# whatever happens the coordinator must get an answer, or it waits forever
+	except Exception as e:
+		reply['ok'] = False
+		reply['error'] = str(e)
+	reply['duration'] = time.time() - start
+	with lock:
+		out.write(json.dumps(reply) + '\n')
+		out.flush()
+	return
+
+def run_agent(inp = sys.stdin, out = sys.stdout):
+	line = inp.readline()
+	if line == '':
+		return
+	config = json.loads(line)
+	lock = Lock()
+	with ThreadPoolExecutor(max_workers = config['slots'], thread_name_prefix = 'agent_worker_') as executor:
+		for line in inp:
+			executor.submit(_sync_batch, config, json.loads(line)['batch'], out, lock)
+	return
+
+if __name__ == '__main__':
+	run_agent()
@@ -0,0 +1,301 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Spread the batches over several nodes sharing the same file systems. The list is
+# generated and split once by the coordinator, the batch files are written to the
+# temporary directory, which must be reachable with the same path from all nodes. On each
+# node an agent (see agent.py) is started with a command template and runs the rsync
+# processes for the batches it receives. Agent and coordinator talk JSON, one message per
+# line, over the agent standard input and output
+
+import json
+import os
+import shlex
+import sys
+import time
+
+from collections import deque
+from subprocess import Popen as popen, PIPE
+from threading import Thread, Condition
+
+from .rsync import RsyncError
+from .progress import phase
+from .split import default_batch_files, SplitBatchDumper
+from .parallel_rsync import rsync_dir_tree, _run_batches, _raise_list_errors, _is_done, _mark_done
+
+default_node_command = 'ssh {node} {python} -m splitrsync.agent'
+
+class _Node():
+
+	def __init__(self, name, slots):
+		self.name = name
+		self.slots = slots
+		self.process = None
+		self.in_flight = {}
+		self.failed = False
+		self.error = None
+		self.batches = 0
+		self.files = 0
+		self.bytes = 0
+		self.busy_time = 0
+
+	def report(self):
+		return {
+				'node': self.name,
+				'batches': self.batches,
+				'files': self.files,
+				'bytes': self.bytes,
+				'busy_time': self.busy_time,
+				'failed': self.failed,
+				'error': self.error,
+		}
+
+# same interface as parallel_rsync.RsyncBatchScheduler, batches are sent to the agents
+# instead of local workers. Each node runs up to slots batches at the same time. If an agent
+# dies or stops answering properly its batches are given back to the queue and synced by
+# the other nodes. A batch with a rsync error is not retried, the error is reported at the end
+# as with the local scheduler.
+# command is a template formatted with {node} and {python} (the running interpreter), e.g.
+# 'ssh {node} {python} -m splitrsync.agent'. To test on a single machine use
+# '{python} -m splitrsync.agent' with any node names
+class DistributedScheduler():
+
+	def __init__(self, nodes, slots, args, source, dest, command = default_node_command, state = None):
+		if '--delete' in args:
+			raise ValueError('--delete option is forbidden during parallel rsync')
+		self.nodes = [_Node(name, slots) for name in nodes]
+		self.args = args
+		self.source = source
+		self.dest = dest
+		self.command = command
+		self.state = state
+		self.pending = deque()
+		self.cond = Condition()
+		self.input_done = False
+		self.batch_stats = []
+		self.errors = []
+		self.threads = []
+		self.start_time = None
+
+	def _start_agent(self, node):
+		cmd = shlex.split(self.command.format(node = node.name, python = sys.executable))
+		process = popen(cmd, stdin = PIPE, stdout = PIPE, stderr = None)
+		with self.cond:
+			node.process = process
+			self.cond.notify_all()
+		self._send(node, {
+				'args': self.args,
+				'source': os.fsdecode(self.source),
+				'dest': os.fsdecode(self.dest),
+				'slots': node.slots,
+		})
+		return
+
+	def _send(self, node, message):
+		node.process.stdin.write((json.dumps(message) + '\n').encode())
+		node.process.stdin.flush()
+		return
+
+	def _in_flight(self):
+		return sum(len(n.in_flight) for n in self.nodes)
+
+	# the caller must hold self.cond
+	def _fail(self, node, error):
+		if node.failed:
+			return
+		node.failed = True
+		node.error = error
+		print('Node %s failed: %s. Reassigning its %d batches' % (node.name, error, len(node.in_flight)), file=sys.stderr)
+		self.pending.extendleft(node.in_flight.values())
+		node.in_flight = {}
+		if node.process is not None:
+			# whatever it is doing, it will not be recorded
+			node.process.kill()
+		if all(n.failed for n in self.nodes):
+			while len(self.pending) > 0:
+				list_file_path, files, size = self.pending.popleft()
+				self.errors.append((list_file_path, RsyncError('no node left to sync the batch')))
+		self.cond.notify_all()
+		return
+
+	def _sender(self, node):
+		try:
+			self._start_agent(node)
+		except (OSError, IOError) as e:
+			with self.cond:
+				self._fail(node, 'cannot start agent: %s' % str(e))
+			return
+		while True:
+			with self.cond:
+				while not node.failed and \
+						not (len(self.pending) > 0 and len(node.in_flight) < node.slots) and \
+						not (self.input_done and len(self.pending) == 0 and self._in_flight() == 0):
+					self.cond.wait()
+				if node.failed or len(self.pending) == 0:
+					break
+				batch = self.pending.popleft()
+				node.in_flight[batch[0]] = batch
+			try:
+				self._send(node, {'batch': batch[0]})
+			except (OSError, IOError) as e:
+				with self.cond:
+					self._fail(node, 'cannot send batch: %s' % str(e))
+				break
+		# no more work, the agent exits once done with what it has
+		try:
+			node.process.stdin.close()
+		except (OSError, IOError):
+			pass
+		return
+
+	def _reader(self, node):
+		# wait for the agent to be started by the sender
+		with self.cond:
+			while node.process is None and not node.failed:
+				self.cond.wait()
+		if node.failed:
+			return
+		for line in node.process.stdout:
+			try:
+				reply = json.loads(line)
+				batch = node.in_flight[reply['batch']]
+			except (ValueError, KeyError):
+				with self.cond:
+					self._fail(node, 'unexpected agent output %r' % line)
+				break
+			self._record(node, batch, reply)
+		node.process.wait()
+		with self.cond:
+			if len(node.in_flight) > 0 or not self.input_done or len(self.pending) > 0:
+				self._fail(node, 'agent exited with returncode %d' % node.process.returncode)
+		return
+
+	def _record(self, node, batch, reply):
+		list_file_path, files, size = batch
+		failed = not reply['ok']
+		with self.cond:
+			del node.in_flight[list_file_path]
+			node.batches += 1
+			node.busy_time += reply['duration']
+			if failed:
+				self.errors.append((list_file_path, RsyncError('rsync on node %s failed' % node.name, reply['error'])))
+			else:
+				node.files += files if files is not None else 0
+				node.bytes += size if size is not None else 0
+			self.batch_stats.append({
+					'batch': os.path.basename(list_file_path),
+					'node': node.name,
+					'files': files,
+					'bytes': size,
+					'start': time.time() - reply['duration'] - self.start_time,
+					'duration': reply['duration'],
+					'failed': failed,
+			})
+			self.cond.notify_all()
+		if not failed:
+			_mark_done(self.state, os.path.basename(list_file_path))
+		return
+
+	def _run_node(self, node):
+		reader = Thread(name = 'Reader for node %s' % node.name, target = self._reader, args = (node,))
+		reader.start()
+		self._sender(node)
+		with self.cond:
+			self.cond.notify_all()
+		reader.join()
+		return
+
+	def start(self):
+		self.start_time = time.time()
+		for node in self.nodes:
+			t = Thread(name = 'Node %s' % node.name, target = self._run_node, args = (node,))
+			self.threads.append(t)
+			t.start()
+		return
+
+	def submit(self, list_file_path, files = None, size = None):
+		if _is_done(self.state, os.path.basename(list_file_path)):
+			return
+		with self.cond:
+			if all(n.failed for n in self.nodes):
+				self.errors.append((list_file_path, RsyncError('no node left to sync the batch')))
+				return
+			self.pending.append((list_file_path, files, size))
+			self.cond.notify_all()
+		return
+
+	def abort(self):
+		with self.cond:
+			self.pending.clear()
+			self.input_done = True
+			self.cond.notify_all()
+		return
+
+	def finish(self):
+		with self.cond:
+			self.input_done = True
+			self.cond.notify_all()
+		for t in self.threads:
+			t.join()
+		return
+
+	def check_errors(self):
+		_raise_list_errors(self.errors, 'batches')
+		return
+
+	def node_stats(self):
+		return [n.report() for n in self.nodes]
+
+	def print_summary(self):
+		elapsed = time.time() - self.start_time
+		for n in self.nodes:
+			print('Node %s: %d batches, %d files, %d bytes, %.1f MB/s%s' % (n.name, n.batches, n.files, n.bytes,
+					n.bytes / elapsed / 1024**2 if elapsed > 0 else 0, ', FAILED: %s' % n.error if n.failed else ''))
+		total = sum(n.bytes for n in self.nodes)
+		print('All nodes: %d bytes, %.1f MB/s' % (total, total / elapsed / 1024**2 if elapsed > 0 else 0))
+		return
+
+	def dump_report(self, path):
+		with open(path, 'w') as f:
+			json.dump(sorted(self.batch_stats, key = lambda b: b['start']), f, indent = 1)
+		return
+
+# as parallel_rsync.prsync_queue with the batches synced by the agents on nodes, slots
+# rsync processes on each of them. split_list.nproc should be len(nodes) * slots. The
+# directory tree is synced locally at the end
+def prsync_distributed(args, split_list, source, dest, nodes, slots, command = default_node_command,
+		batch_files = default_batch_files, batch_bytes = None, progress = None):
+	scheduler = DistributedScheduler(nodes, slots, args, source, dest, command, split_list.state)
+	dumper = SplitBatchDumper(split_list.nproc, split_list.split_func, split_list.tmpdir, scheduler.submit, batch_files, batch_bytes,
+			split_list.large_size, split_list.small_size)
+	print('Starting agents on %d nodes with %d rsync processes each' % (len(nodes), slots))
+	with phase(progress, 'transfer'):
+		_run_batches(scheduler, dumper, lambda: split_list.feed_items(dumper.add_item))
+	split_list.split_file_list = dumper.batch_list
+	split_list.dir_list_path = dumper.dir_list_path
+	split_list.large_list_path = dumper.large_list_path
+	split_list.small_list_path = dumper.small_list_path
+	scheduler.print_summary()
+	print('Syncing directory tree')
+	with phase(progress, 'dir_tree'):
+		rsync_dir_tree(args, split_list, source, dest)
+	scheduler.check_errors()
+	return scheduler
@@ -0,0 +1,137 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# rsync -H preserves hard links only between files of the same transfer. Splitting the
+# files between parallel rsync processes would copy the data of each inode once for every
+# list holding one of its names, as independent files. Files with more than one link are
+# therefore taken out of the normal split and grouped by inode, every group goes as a whole
+# to one of the hard link lists, so each inode is written once and its links are kept
+
+import os
+import stat
+import sys
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .item_list import directory_symbol
+from .scanner import stat_chunk_size
+from .split import LPTSplit, default_file_cost
+
+def _nlink_chunk(source, chunk):
+	links = []
+	for is_dir, size, path in chunk:
+		if is_dir == directory_symbol:
+			links.append(None)
+			continue
+		try:
+			st = os.lstat(os.path.join(source, path.lstrip(b'/')))
+		except OSError as e:
+			# leave it to rsync to report the error
+			print('WARNING: cannot stat %s: %s' % (os.fsdecode(path), e.strerror), file = sys.stderr)
+			links.append(None)
+			continue
+		if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+			links.append((st.st_dev, st.st_ino, st.st_size))
+		else:
+			links.append(None)
+	return links
+
+# filters the items given to an item function (is_dir, size, path), see split.split_items.
+# The items are stat-ed by nthreads threads in chunks of stat_chunk_size and passed on in
+# the same order, except regular files with more than one link which are kept in memory,
+# grouped by inode, until dump
+class HardLinkFilter():
+
+	def __init__(self, source, nthreads, file_cost = default_file_cost):
+		self.source = source
+		self.nthreads = nthreads
+		self.file_cost = file_cost
+		self.groups = {}
+		self.files = 0
+		self.elapsed = 0
+
+	def _emit(self, future, item_func):
+		chunk, links = future.result()
+		for item, link in zip(chunk, links):
+			if link is None:
+				item_func(*item)
+				continue
+			group = self.groups.get(link[:2])
+			if group is None:
+				group = self.groups[link[:2]] = (link[2], [])
+			group[1].append(item[2])
+			self.files += 1
+		return
+
+	def _submit(self, executor, chunk, pending, item_func):
+		pending.append(executor.submit(lambda: (chunk, _nlink_chunk(self.source, chunk))))
+		if len(pending) >= 4 * self.nthreads:
+			self._emit(pending.popleft(), item_func)
+		return
+
+	# same as feed_func(item_func), without the hard linked files
+	def feed(self, feed_func, item_func):
+		start = time.time()
+		pending = deque()
+		chunk = []
+		with ThreadPoolExecutor(max_workers = self.nthreads, thread_name_prefix = 'link_worker_') as executor:
+			def add_item(is_dir, size, path):
+				chunk.append((is_dir, size, path))
+				if len(chunk) >= stat_chunk_size:
+					self._submit(executor, chunk[:], pending, item_func)
+					chunk.clear()
+				return
+			feed_func(add_item)
+			if len(chunk) > 0:
+				self._submit(executor, chunk[:], pending, item_func)
+			while len(pending) > 0:
+				self._emit(pending.popleft(), item_func)
+		self.elapsed += time.time() - start
+		return
+
+	# write the groups to n lists, name % i in tmpdir, balanced by size with every group
+	# counted once, largest first. All n lists are written, empty ones too, so their names
+	# are known when resuming. Returns the list paths and the parents of the listed files
+	def dump(self, n, tmpdir, name = 'list-links-%d'):
+		split = LPTSplit(self.file_cost)
+		list_paths = [tmpdir + '/' + name % i for i in range(n)]
+		fds = [open(p, 'wb') for p in list_paths]
+		parents = set()
+		try:
+			for size, paths in sorted(self.groups.values(), key = lambda g: g[0], reverse = True):
+				fds[split(n = n, size = b'%d' % size)].write(b'\0'.join(paths) + b'\0')
+				parents.update(os.path.dirname(p.rstrip(b'/')) or b'.' for p in paths)
+		finally:
+			for fd in fds:
+				fd.close()
+		print('Found %d hard linked files, %d inodes with %d bytes, split in %d lists' % (self.files, len(self.groups),
+				sum(g[0] for g in self.groups.values()), n))
+		return list_paths, sorted(parents)
+
+	def stats(self):
+		return {
+				'files': self.files,
+				'inodes': len(self.groups),
+				'bytes': sum(g[0] for g in self.groups.values()),
+				'time': self.elapsed,
+		}
@@ -0,0 +1,131 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# On disk index of the source tree as it was at the end of the last successful run: for
+# each directory its modification time and the mode, owner, group, size and modification
+# time of each entry. The native scanner uses it to avoid listing directories which did not change.
+# A new index is written while scanning and replaces the old one only when the run
+# completes, so an interrupted run never leaves a partially updated index behind
+
+import os
+import sqlite3
+
+from threading import Lock, local
+
+index_name = 'index.sqlite'
+# bumped when the schema changes, an index of another version is ignored and rebuilt
+index_version = 1
+
+_schema = [
+	'CREATE TABLE IF NOT EXISTS dirs (path BLOB PRIMARY KEY, mtime_ns INTEGER)',
+	'CREATE TABLE IF NOT EXISTS entries (dir BLOB, name BLOB, mode INTEGER, uid INTEGER, gid INTEGER, ' \
+		'size INTEGER, mtime_ns INTEGER, PRIMARY KEY (dir, name))',
+]
+
+# behaves like an os.stat_result for what the scanner needs
+class CachedStat():
+
+	def __init__(self, mode, uid, gid, size, mtime_ns):
+		self.st_mode = mode
+		self.st_uid = uid
+		self.st_gid = gid
+		self.st_size = size
+		self.st_mtime_ns = mtime_ns
+		self.st_mtime = mtime_ns / 1e9
+
+class MetadataIndex():
+
+	def __init__(self, state_dir):
+		self.path = os.path.join(state_dir, index_name)
+		self.new_path = self.path + '.new'
+		self.readers = local()
+		self.write_lock = Lock()
+		self.writer = None
+		self.has_old = False
+
+	# full_rescan = True ignores the old index, a new one is still written
+	def open(self, full_rescan = False):
+		self.has_old = os.path.exists(self.path) and not full_rescan and self._old_version() == index_version
+		if os.path.exists(self.new_path):
+			os.unlink(self.new_path)
+		self.writer = sqlite3.connect(self.new_path, check_same_thread = False)
+		self.writer.execute('PRAGMA journal_mode = OFF')
+		self.writer.execute('PRAGMA synchronous = OFF')
+		self.writer.execute('PRAGMA user_version = %d' % index_version)
+		for statement in _schema:
+			self.writer.execute(statement)
+		return
+
+	def _old_version(self):
+		conn = sqlite3.connect('file:%s?mode=ro' % self.path, uri = True)
+		try:
+			return conn.execute('PRAGMA user_version').fetchone()[0]
+		finally:
+			conn.close()
+
+	def _reader(self):
+		conn = getattr(self.readers, 'conn', None)
+		if conn is None:
+			conn = sqlite3.connect('file:%s?mode=ro' % self.path, uri = True)
+			self.readers.conn = conn
+		return conn
+
+	# returns None if rel is not in the index, otherwise a (mtime_ns, entries) pair where
+	# entries maps every name in the directory to a CachedStat
+	def lookup(self, rel):
+		if not self.has_old:
+			return None
+		conn = self._reader()
+		row = conn.execute('SELECT mtime_ns FROM dirs WHERE path = ?', (rel,)).fetchone()
+		if row is None:
+			return None
+		entries = {}
+		for name, mode, uid, gid, size, mtime_ns in conn.execute(
+				'SELECT name, mode, uid, gid, size, mtime_ns FROM entries WHERE dir = ?', (rel,)):
+			entries[bytes(name)] = CachedStat(mode, uid, gid, size, mtime_ns)
+		return row[0], entries
+
+	# records is a list of (name, mode, uid, gid, size, mtime_ns)
+	def record(self, rel, mtime_ns, records):
+		with self.write_lock:
+			self.writer.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (rel, mtime_ns))
+			self.writer.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+					((rel,) + r for r in records))
+		return
+
+	def close(self):
+		if self.writer is not None:
+			self.writer.commit()
+			self.writer.close()
+			self.writer = None
+		return
+
+	# the run completed, the new index replaces the old one
+	def commit(self):
+		self.close()
+		os.replace(self.new_path, self.path)
+		return
+
+	def discard(self):
+		self.close()
+		if os.path.exists(self.new_path):
+			os.unlink(self.new_path)
+		return
@@ -20,17 +20,26 @@
 ##############################################################################
 
 import io
+import mmap
+import os
 import re
+import stat
 import sys
 
-from .rsync import check_rsync_output
+from .profiling import profiled
+from .rsync import stream_rsync_output
 from . import default_buffer_size
 
 rsync_list_re = re.compile(r'^(?P<change>[\w.*<>+]+) +(?P<size>\d+) (?P<path>.*)$')
+rsync_list_bre = re.compile(br'^(?P<change>[\w.*<>+]+) +(?P<size>\d+) (?P<path>.*)$')
 path_escape_re = re.compile(br'\\#(?P<oct>\d{3})')
 
 file_symbol = b'F'
 directory_symbol = b'D'
+# a regular file not found in the destination. Anything not a directory is handled as a
+# file, this only allows to pick new files for a faster copy
+new_file_symbol = b'N'
+new_file_change = b'>f+++++++++'
 delete_symbol = b'RM'
 
 sane_path_len = 4096
@@ -61,45 +70,66 @@ class RsyncItem():
 def _rsync_esc2char(matchobj):
 	return bytes([int(matchobj.group('oct'), 8)])
 
+def _rsync_list_args(rsync_opts, source, dest):
+	#rsync_args = deepcopy(rsync_opts)
+	rsync_args = rsync_opts[:]
+	rsync_args.append('--dry-run')
+	rsync_args.append(r'--out-format=%i %l %n')
+	# rsync_args.append(r'--8-bit-output') ## not really know what this does. Keep it as a note, it might be useful
+	rsync_args.append(source)
+	rsync_args.append(dest)
+	return rsync_args
+
+def _process_rsync_line(line, item_func, delete_func, unknown_lines):
+	if line == b'':
+		return
+	m = rsync_list_bre.search(line)
+	if m is None:
+		# check for "skipping non-regular file", it's normal rsync skips fifos
+		# sockets or other non regular files
+		if line.startswith(b'skipping non-regular file'):
+			print(os.fsdecode(line), file = sys.stderr)
+		else:
+			print('WARNING: unrecognized rsync output line: %s' % os.fsdecode(line), file=sys.stderr)
+			unknown_lines.append(line)
+		return
+	change = m.group('change')
+	path = path_escape_re.sub(_rsync_esc2char, m.group('path'))
+	if change == b'*deleting':
+		delete_func(path)
+	else:
+		isdir = file_symbol
+		if change[1] == b'd'[0]:  # a bit ugly
+			isdir = directory_symbol
+		elif change == new_file_change:
+			isdir = new_file_symbol
+		item_func(isdir, m.group('size'), path)
+	return
+
+# run the rsync dry run and hand every item to item_func(isdir, size, path) and every
+# extraneous file to delete_func(path) as soon as rsync prints it. Nothing is buffered
+# besides the current line, so the caller can start working on the items while rsync is
+# still scanning the trees
+def generate_list_stream(rsync_opts, source, dest, item_func, delete_func):
+	unknown_lines = []
+	with profiled('generate_list'):
+		stream_rsync_output(
+				_rsync_list_args(rsync_opts, source, dest),
+				lambda line: _process_rsync_line(line, item_func, delete_func, unknown_lines),
+				role = 'list'
+		)
+	return unknown_lines
+
 def generate_list(rsync_opts, source, dest, list_path, delete_path):
-	with open(list_path, 'wb') as list_fd, open(delete_path, 'wb') as delete_fd:
-		#rsync_args = deepcopy(rsync_opts)
-		rsync_args = rsync_opts[:]
-		rsync_args.append('--dry-run')
-		rsync_args.append(r'--out-format=%i %l %n')
-		# rsync_args.append(r'--8-bit-output') ## not really know what this does. Keep it as a note, it might be useful
-		rsync_args.append(source)
-		rsync_args.append(dest)
-
-		(out, err) = check_rsync_output(rsync_args)
-		#print('OUTPUT:\n%s\n\n\nERROR:\n%s\n' % (out, err))
-
-		unknown_lines = []
-		rsync_items = [] 
-		for line in out.split('\n'):
-			if line is None or line == '':
-				continue
-			m = rsync_list_re.search(line)
-			if m is None:
-				# check for "skipping non-regular file", it's normal rsync skips fifos
-				# sockets or other non regular files
-				if line.startswith('skipping non-regular file'):
-					print(line, file = sys.stderr)
-				else:
-					print('WARNING: unrecognized rsync output line: %s' % line, file=sys.stderr)
-					unknown_lines.append(line)
-				continue
-			change = m.group('change').encode()
-			size = m.group('size').encode()
-			raw_path = m.group('path').encode()
-			path = path_escape_re.sub(_rsync_esc2char, raw_path)
-			if change == b'*deleting':
-				delete_fd.write(path + b'\0')
-			else:
-				isdir = file_symbol
-				if change[1] == b'd'[0]:  # a bit ugly
-					isdir = directory_symbol
-				list_fd.write(isdir + b' ' + size + b' ' + path + b'\0')
+	with open(list_path, 'wb', buffering = default_buffer_size) as list_fd, \
+			open(delete_path, 'wb', buffering = default_buffer_size) as delete_fd:
+		generate_list_stream(
+				rsync_opts,
+				source,
+				dest,
+				lambda isdir, size, path: list_fd.write(isdir + b' ' + size + b' ' + path + b'\0'),
+				lambda path: delete_fd.write(path + b'\0')
+		)
 	return
 
 def dump_list(item_list, path):
@@ -108,6 +138,16 @@ def dump_list(item_list, path):
 			f.write('%s\0' % item.path)
 	return
 
+def _corrupt_list_error(sep):
+	return RuntimeError(
+			'Possible corrupt input file. Cannot find a end of line separator %s ' \
+			'after %d characters. If you specified a list of files with --files-from ' \
+			'you should use --from0 if you used \\0 as field separator, otherwise ' \
+			'you should *not* use --from0. If you didn\'t specify a list of file ' \
+			'with --files-from the temporary file internally created was likely corrupted' %
+			(sep, sane_path_len)
+		)
+
 def read_list_process_line(list_path, sep, process_func, args):
 	with open(list_path, 'rb', buffering = default_buffer_size) as list_fd:
 		#list_fd = io.BufferedReader(fd, buffer_size = default_buffer_size)
@@ -124,16 +164,91 @@ def read_list_process_line(list_path, sep, process_func, args):
 				# malformed files can go on forever here, if we keep reading without
 				# finding a separator after reaching a maximum possible path length
 				# just stop and abort
-				raise RuntimeError(
-						'Possible corrupt input file. Cannot find a end of line separator %s ' \
-						'after %d characters. If you specified a list of files with --files-from ' \
-						'you should use --from0 if you used \\0 as field separator, otherwise ' \
-						'you should *not* use --from0. If you didn\'t specify a list of file ' \
-						'with --files-from the temporary file internally created was likely corrupted' %
-						(sep, sane_path_len)
-					)
+				raise _corrupt_list_error(sep)
 			buf = list_fd.read(default_buffer_size)
 		# process last item in case the list doesn't end with the sep char
 		if next_item != b'':
 			process_func(*((next_item,) + args))
 	return
+
+# memory mapping and byte ranges need a regular file, a list can also be a pipe, e.g.
+# --files-from <(find ...)
+def is_regular_list(list_path):
+	return stat.S_ISREG(os.stat(list_path).st_mode)
+
+# read_list_batches for lists which can't be memory mapped, read sequentially
+def _stream_list_batches(list_path, sep, batch_func, args, batch_size):
+	with open(list_path, 'rb', buffering = 0) as list_fd:
+		next_item = b''
+		buf = list_fd.read(batch_size)
+		while len(buf) > 0:
+			# short reads are normal on pipes, fill the batch before cutting it
+			while len(buf) < batch_size:
+				more = list_fd.read(batch_size - len(buf))
+				if len(more) == 0:
+					break
+				buf += more
+			records = (next_item + buf).split(sep)
+			next_item = records.pop()
+			if len(next_item) > sane_path_len:
+				raise _corrupt_list_error(sep)
+			if len(records) > 0:
+				batch_func(records, *args)
+			buf = list_fd.read(batch_size)
+		if next_item != b'':
+			batch_func([next_item], *args)
+	return
+
+# split the file at list_path in n byte ranges (start, end), each starting right after a sep
+# so no record is cut. Ranges can be empty on small files. list_path must be a regular file
+def list_ranges(list_path, sep, n):
+	if not is_regular_list(list_path):
+		raise ValueError('%s is not a regular file, it cannot be split in ranges' % list_path)
+	size = os.path.getsize(list_path)
+	if size == 0:
+		return []
+	with open(list_path, 'rb') as list_fd, mmap.mmap(list_fd.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+		bounds = [0]
+		for i in range(1, n):
+			pos = mm.find(sep, max(size * i // n, bounds[-1]))
+			bounds.append(pos + 1 if pos >= 0 else size)
+		bounds.append(size)
+	return [(bounds[i], bounds[i + 1]) for i in range(n)]
+
+# same records as read_list_process_line, but the file is memory mapped and
+# batch_func(records, *args) is called once for every list of records found in about
+# batch_size bytes. start and end limit the reading to a range from list_ranges. Lists
+# which are not regular files, e.g. pipes, are read sequentially, without ranges
+def read_list_batches(list_path, sep, batch_func, args = (), batch_size = default_buffer_size, start = 0, end = None):
+	if not is_regular_list(list_path):
+		if start != 0 or end is not None:
+			raise ValueError('%s is not a regular file, it cannot be read in ranges' % list_path)
+		_stream_list_batches(list_path, sep, batch_func, args, batch_size)
+		return
+	size = os.path.getsize(list_path)
+	if end is None:
+		end = size
+	if size == 0 or start >= end:
+		return
+	with open(list_path, 'rb') as list_fd, mmap.mmap(list_fd.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+		pos = start
+		while pos < end:
+			cut = -1
+			if pos + batch_size < end:
+				cut = mm.find(sep, pos + batch_size, end)
+			if cut >= 0:
+				if cut - pos - batch_size > sane_path_len:
+					raise _corrupt_list_error(sep)
+				chunk = mm[pos:cut + 1]
+				pos = cut + 1
+			else:
+				if end - pos > batch_size + sane_path_len:
+					raise _corrupt_list_error(sep)
+				chunk = mm[pos:end]
+				pos = end
+			records = chunk.split(sep)
+			# the empty string after the last separator is not a record
+			if chunk.endswith(sep):
+				records.pop()
+			batch_func(records, *args)
+	return
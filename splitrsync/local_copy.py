@@ -0,0 +1,296 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Copy files without rsync, for local to local transfers only. Used where rsync is the
+# bottleneck: a single huge file can be copied by many threads in parallel byte ranges
+
+import errno
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .item_list import read_list_process_line
+from . import default_buffer_size
+
+default_range_size = 256 * 1024**2 # 256MB
+tmp_name = b'.%s.splitrsync'
+
+# rsync options and the metadata they preserve
+_metadata_opts = {
+	'-a': ('times', 'perms', 'owner', 'group'),
+	'--archive': ('times', 'perms', 'owner', 'group'),
+	'--times': ('times',),
+	'--perms': ('perms',),
+	'-o': ('owner',),
+	'--owner': ('owner',),
+	'-g': ('group',),
+	'--group': ('group',),
+	'-X': ('xattrs',),
+	'--xattrs': ('xattrs',),
+	'-A': ('acls', 'perms'),
+	'--acls': ('acls', 'perms'),
+}
+
+_acl_xattrs = (b'system.posix_acl_access', b'system.posix_acl_default')
+
+class CopyError(Exception):
+	pass
+
+def metadata_flags(rsync_args):
+	flags = set()
+	for arg in rsync_args:
+		flags.update(_metadata_opts.get(arg, ()))
+	return flags
+
+def _copy_xattrs(src_fd, dst_fd, flags):
+	try:
+		names = os.listxattr(src_fd)
+	except OSError as e:
+		if e.errno in (errno.ENOTSUP, errno.ENODATA):
+			return
+		raise
+	for name in names:
+		is_acl = os.fsencode(name) in _acl_xattrs
+		if (is_acl and 'acls' not in flags) or (not is_acl and 'xattrs' not in flags):
+			continue
+		os.setxattr(dst_fd, name, os.getxattr(src_fd, name))
+	return
+
+# apply the metadata requested by flags (see metadata_flags) from the stat result st of the
+# source to the open destination file. Ownership goes first as chown can clear setuid bits
+def apply_metadata(src_fd, dst_fd, st, flags):
+	if 'owner' in flags or 'group' in flags:
+		os.fchown(dst_fd,
+				st.st_uid if 'owner' in flags else -1,
+				st.st_gid if 'group' in flags else -1)
+	if 'perms' in flags:
+		os.fchmod(dst_fd, st.st_mode & 0o7777)
+	if 'xattrs' in flags or 'acls' in flags:
+		_copy_xattrs(src_fd, dst_fd, flags)
+	if 'times' in flags:
+		os.utime(dst_fd, ns = (st.st_atime_ns, st.st_mtime_ns))
+	return
+
+# rsync default quick check: same size and same modification time means nothing to do
+def is_uptodate(st, dest_path):
+	try:
+		dst_st = os.stat(dest_path)
+	except FileNotFoundError:
+		return False
+	return dst_st.st_size == st.st_size and dst_st.st_mtime_ns == st.st_mtime_ns
+
+def _pread_pwrite(src_fd, dst_fd, offset, count):
+	while count > 0:
+		buf = os.pread(src_fd, min(count, default_buffer_size), offset)
+		if len(buf) == 0:
+			raise OSError(errno.EIO, 'unexpected end of file at offset %d' % offset)
+		written = os.pwrite(dst_fd, buf, offset)
+		offset += written
+		count -= written
+	return
+
+def copy_range(src_fd, dst_fd, offset, count):
+	if hasattr(os, 'copy_file_range'):
+		try:
+			while count > 0:
+				copied = os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+				if copied == 0:
+					raise OSError(errno.EIO, 'unexpected end of file at offset %d' % offset)
+				offset += copied
+				count -= copied
+			return
+		except OSError as e:
+			# cross file system copies are not supported by older kernels, fall back
+			if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+				raise
+	_pread_pwrite(src_fd, dst_fd, offset, count)
+	return
+
+def _preallocate(fd, size):
+	if size == 0:
+		return
+	try:
+		os.posix_fallocate(fd, 0, size)
+	except OSError as e:
+		if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+			raise
+		os.ftruncate(fd, size)
+	return
+
+# copy a single file using up to all threads of the executor, each one copying a range of
+# range_size bytes. Data is written to a temporary file in the same directory which is
+# renamed once everything is in place, the same way rsync does it. Returns bytes copied
+def copy_file_parallel(src_path, dest_path, executor, flags, range_size = default_range_size):
+	src_fd = os.open(src_path, os.O_RDONLY)
+	try:
+		st = os.fstat(src_fd)
+		if is_uptodate(st, dest_path):
+			# the data is the same, as rsync still bring mode, ownership and attributes up
+			# to date
+			if len(flags) > 0:
+				dst_fd = os.open(dest_path, os.O_RDONLY | os.O_NOFOLLOW)
+				try:
+					apply_metadata(src_fd, dst_fd, st, flags)
+				finally:
+					os.close(dst_fd)
+			return 0
+		dest_dir, dest_name = os.path.split(dest_path)
+		tmp_path = os.path.join(dest_dir, tmp_name % dest_name)
+		os.makedirs(dest_dir, exist_ok = True)
+		dir_st = os.stat(dest_dir)
+		dst_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, st.st_mode & 0o777)
+		try:
+			_preallocate(dst_fd, st.st_size)
+			futures = [executor.submit(copy_range, src_fd, dst_fd, offset, min(range_size, st.st_size - offset))
+					for offset in range(0, st.st_size, range_size)]
+			for f in futures:
+				f.result()
+			apply_metadata(src_fd, dst_fd, st, flags)
+		except BaseException:
+			os.close(dst_fd)
+			os.unlink(tmp_path)
+			raise
+		os.close(dst_fd)
+		os.rename(tmp_path, dest_path)
+		if 'times' in flags:
+			# the directory tree was already synced, don't leave its mtime changed
+			os.utime(dest_dir, ns = (dir_st.st_atime_ns, dir_st.st_mtime_ns))
+	finally:
+		os.close(src_fd)
+	return st.st_size
+
+def _append_item(item, items):
+	items.append(item)
+	return
+
+# copy every file in list_path (paths relative to source, \0 separated) one at a time, each
+# of them split in ranges copied by nthreads threads
+def copy_large_files(list_path, source, dest, nthreads, rsync_args, range_size = default_range_size):
+	flags = metadata_flags(rsync_args)
+	items = []
+	read_list_process_line(list_path, b'\0', _append_item, (items,))
+	if len(items) == 0:
+		return
+	print('Copying %d large files with %d threads' % (len(items), nthreads))
+	start = time.time()
+	copied = 0
+	with ThreadPoolExecutor(max_workers = nthreads, thread_name_prefix = 'range_copy_') as executor:
+		for path in items:
+			copied += copy_file_parallel(os.path.join(source, path), os.path.join(dest, path), executor, flags, range_size)
+	elapsed = time.time() - start
+	print('Large files copied: %d bytes in %.1f seconds (%.1f MB/s)' % (
+			copied, elapsed, copied / 1024**2 / elapsed if elapsed > 0 else 0))
+	return
+
+small_batch_size = 1000
+
+# copy a whole file not found in the destination when the list was generated. No temporary
+# file: if interrupted the partial file has the wrong size or modification time and is
+# synced again by the next run. Returns bytes copied
+def copy_small_file(src_path, dest_path, flags):
+	src_fd = os.open(src_path, os.O_RDONLY)
+	try:
+		st = os.fstat(src_fd)
+		dst_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, st.st_mode & 0o777)
+		try:
+			copy_range(src_fd, dst_fd, 0, st.st_size)
+			apply_metadata(src_fd, dst_fd, st, flags)
+		finally:
+			os.close(dst_fd)
+	finally:
+		os.close(src_fd)
+	return st.st_size
+
+# a file failing must not stop the batch: as rsync, files gone from the source are only
+# reported, other errors are collected and the copy goes on
+def _copy_small_batch(batch, source, dest, flags):
+	copied = 0
+	files = 0
+	parents = set()
+	vanished = []
+	errors = []
+	for path in batch:
+		src_path = os.path.join(source, path)
+		try:
+			copied += copy_small_file(src_path, os.path.join(dest, path), flags)
+			files += 1
+		except FileNotFoundError as e:
+			if e.filename != src_path:
+				errors.append((path, e))
+			else:
+				vanished.append(path)
+		except OSError as e:
+			errors.append((path, e))
+		parents.add(os.path.dirname(path))
+	return files, copied, parents, vanished, errors
+
+def _submit_small(path, batch, futures, executor, source, dest, flags):
+	batch.append(path)
+	if len(batch) >= small_batch_size:
+		futures.append(executor.submit(_copy_small_batch, batch[:], source, dest, flags))
+		batch.clear()
+	return
+
+# copy the new small files in list_path (paths relative to source, \0 separated) with
+# nthreads threads, each file in a single copy_file_range call instead of going through the
+# rsync protocol. Must run after the directory tree is synced: the modification time of the
+# parent directories is fixed at the end. Files which could not be copied are printed and
+# counted in the stats as failed, the caller decides what to do with them. Returns the stats
+# of the copy
+def copy_small_files(list_path, source, dest, nthreads, rsync_args):
+	flags = metadata_flags(rsync_args)
+	start = time.time()
+	files = 0
+	copied = 0
+	parents = set()
+	vanished = []
+	errors = []
+	batch = []
+	futures = []
+	with ThreadPoolExecutor(max_workers = nthreads, thread_name_prefix = 'small_copy_') as executor:
+		read_list_process_line(list_path, b'\0', _submit_small, (batch, futures, executor, source, dest, flags))
+		if len(batch) > 0:
+			futures.append(executor.submit(_copy_small_batch, batch, source, dest, flags))
+		for f in futures:
+			batch_files, batch_bytes, batch_parents, batch_vanished, batch_errors = f.result()
+			files += batch_files
+			copied += batch_bytes
+			parents |= batch_parents
+			vanished += batch_vanished
+			errors += batch_errors
+	if 'times' in flags:
+		for parent in parents:
+			try:
+				st = os.stat(os.path.join(source, parent))
+				os.utime(os.path.join(dest, parent), ns = (st.st_atime_ns, st.st_mtime_ns))
+			except OSError as e:
+				errors.append((parent, e))
+	for path in vanished:
+		print('WARNING: file has vanished: %s' % os.fsdecode(path), file = sys.stderr)
+	for path, e in errors:
+		print('WARNING: cannot copy %s: %s' % (os.fsdecode(path), e.strerror), file = sys.stderr)
+	elapsed = time.time() - start
+	if files > 0:
+		print('Small files copied: %d files, %d bytes in %.1f seconds (%.0f files/s, %.1f MB/s)' % (
+				files, copied, elapsed, files / elapsed if elapsed > 0 else 0, copied / 1024**2 / elapsed if elapsed > 0 else 0))
+	return {'files': files, 'bytes': copied, 'time': elapsed, 'vanished': len(vanished), 'failed': len(errors)}
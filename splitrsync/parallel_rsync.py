@@ -20,49 +20,129 @@
 ##############################################################################
 
 import errno
+import json
 import os
 import shutil
+import time
 
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from queue import Queue, Empty
 from subprocess import Popen as popen, DEVNULL
 from tempfile import mkstemp
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 
-from .rsync import check_rsync_output
-from .item_list import read_list_process_line
-from .split import read_split_dump, default_split_list
+from .rsync import check_rsync_output, stream_rsync_output, has_filter_rules, RsyncError, RsyncPipe, default_pipe_buffer
+from .profiling import profiled
+from .progress import progress_rsync_args, phase
+from .item_list import read_list_process_line, generate_list_stream
+from .split import read_split_dump, split_dir_tree, print_split_stats, default_split_list, default_batch_files, SplitBatchDumper, \
+		split_items, feed_item_list
 
 join_timeout = 2419200 # 1 month
+default_adapt_interval = 30
 
 class RsyncSplitList():
 	
-	def __init__(self, nproc, item_list_file, sep, tmpdir, split_func):
+	def __init__(self, nproc, item_list_file, sep, tmpdir, split_func, large_size = None, dir_depth = 1, small_size = None):
 		self.nproc = nproc
 		self.dir_list_path = None
+		self.dir_depth = dir_depth
+		# a state.RunState to resume an interrupted run, or None
+		self.state = None
+		# processes parsing the item list, see split.read_split_dump
+		self.parse_processes = 1
+		# if not None the items come from feed_func instead of item_list_file, see split.split_items
+		self.feed_func = None
+		# a hard_links.HardLinkFilter or None. If given the hard linked files are written to
+		# links_list_paths instead of the split lists, and their parents to links_dir_list_path
+		self.hard_links = None
+		self.links_list_paths = None
+		self.links_dir_list_path = None
+		self.large_size = large_size
+		self.large_list_path = None
+		if large_size is not None:
+			self.large_list_path = tmpdir + '/list-large'
+		self.small_size = small_size
+		self.small_list_path = None
+		if small_size is not None:
+			self.small_list_path = tmpdir + '/list-small'
 		self.delete_list_path = None
 		self.dump_dir = None
 		self.item_list_file = item_list_file
 		self.sep = sep
 		self.split_file_list = None
+		self.split_stats = []
 		self.split_func = default_split_list
 		self.tmpdir = tmpdir
 		if split_func is not None:
 			self.split_func = split_func
 
 	def split_and_dump(self):
-		# don't dump again if we already did
+		# don't dump again if we already did, or if an interrupted run did
+		if self.split_file_list is None and _is_done(self.state, 'split'):
+			self.split_file_list = [self.tmpdir + '/' + 'list-%d' % i for i in range(self.nproc)]
+			self.dir_list_path = self.tmpdir + '/' + 'list-dir'
+			if self.hard_links is not None:
+				self.links_list_paths = [self.tmpdir + '/' + 'list-links-%d' % i for i in range(self.nproc)]
+				self.links_dir_list_path = self.tmpdir + '/' + 'list-links-dir'
 		if self.split_file_list is None:
 			split_list_files, dir_list = read_split_dump(
 					self.item_list_file,
 					self.sep,
 					self.nproc,
 					self.split_func,
-					self.tmpdir
+					self.tmpdir,
+					stats = self.split_stats,
+					large_size = self.large_size,
+					large_list_path = self.large_list_path,
+					small_size = self.small_size,
+					small_list_path = self.small_list_path,
+					parse_processes = self.parse_processes,
+					feed_func = self.filter_feed(self.feed_func)
 			)
 			self.split_file_list = split_list_files
 			self.dir_list_path = dir_list
+			_mark_done(self.state, 'split')
 		return (self.split_file_list, self.dir_list_path)
 
+	def feed_items(self, item_func):
+		feed_func = self.filter_feed(self.feed_func)
+		with profiled('split'):
+			if feed_func is not None:
+				feed_func(item_func)
+			else:
+				feed_item_list(self.item_list_file, self.sep, item_func)
+		return
+
+	# returns feed_func, or the item list if None, without the hard linked files if
+	# self.hard_links is set. They are dumped once feed_func is done
+	def filter_feed(self, feed_func):
+		if self.hard_links is None:
+			return feed_func
+		if feed_func is None:
+			feed_func = partial(feed_item_list, self.item_list_file, self.sep)
+		def feed(item_func):
+			self.hard_links.feed(feed_func, item_func)
+			self.links_list_paths, parents = self.hard_links.dump(self.nproc, self.tmpdir)
+			self.links_dir_list_path = self.tmpdir + '/' + 'list-links-dir'
+			with open(self.links_dir_list_path, 'wb') as f:
+				f.write(b''.join(p + b'\0' for p in parents))
+			return
+		return feed
+
+	def print_stats(self):
+		print_split_stats(self.split_stats)
+		return
+
+def _is_done(state, step):
+	return state is not None and state.is_done(step)
+
+def _mark_done(state, step):
+	if state is not None:
+		state.mark_done(step)
+	return
+
 def init_threads(n, target, args):
 	threads = []
 	for i in range(n):
@@ -88,7 +168,7 @@ def join_threads(threads):
 			pass
 	return
 
-def rsync_dir_tree(args, split_list, source, dest):
+def _rsync_dir_list(args, dir_list_path, source, dest):
 	if '--delete' in args:
 		raise ValueError('--delete option is forbidden during parallel rsync')
 	# our own filter must be added last or it will override the user provided one
@@ -99,39 +179,496 @@ def rsync_dir_tree(args, split_list, source, dest):
 	# so we still want our own filter to exclude all files on get directories only
 	# TODO remove original filters
 	rsync_args = args + ['-f+ */', '-f- *']
-	rsync_args.append('--files-from=%s' % split_list.dir_list_path)
+	rsync_args.append('--files-from=%s' % dir_list_path)
 	rsync_args.append('--from0')
 	#rsync_args.append('--dry-run')
 	#rsync_args.append('--itemize-changes')
 	rsync_args.append(source)
 	rsync_args.append(dest)
-	(out, err) = check_rsync_output(rsync_args)
+	(out, err) = check_rsync_output(rsync_args, log_name = 'dir-tree')
 	#print(out + '\n')
 	#print(err)
 	return
 
-def __rsync_worker(t_number, args, list_file_path, source, dest):
-	if '--delete' in args:
-		raise ValueError('--delete option is forbidden during parallel rsync')
+# sync the directory tree with split_list.nproc processes, one per group of disjoint
+# subtrees (see split.split_dir_tree). The directories above the subtrees are synced first,
+# so all parents exist, and once more at the end to fix their metadata, since creating the
+# subtrees changes the modification time of their parents.
+# With split_list.dir_depth == 0 this is a single process task
+def rsync_dir_tree(args, split_list, source, dest):
+	if split_list.dir_depth == 0 or split_list.nproc == 1:
+		_rsync_dir_list(args, split_list.dir_list_path, source, dest)
+		return
+	top_list_path, dir_lists = split_dir_tree(split_list.dir_list_path, split_list.nproc, split_list.dir_depth, split_list.tmpdir)
+	if os.path.getsize(top_list_path) > 0:
+		_rsync_dir_list(args, top_list_path, source, dest)
+	with ThreadPoolExecutor(max_workers = split_list.nproc, thread_name_prefix = 'dir_worker_') as executor:
+		futures = [executor.submit(_rsync_dir_list, args, path, source, dest)
+				for path in dir_lists if os.path.getsize(path) > 0]
+		for f in futures:
+			f.result()
+	if os.path.getsize(top_list_path) > 0:
+		_rsync_dir_list(args, top_list_path, source, dest)
+	return
+
+def _sync_dir_tree_once(args, split_list, source, dest):
+	if _is_done(split_list.state, 'dir_tree'):
+		print('Directory tree already synced by the interrupted run, skipping')
+		return
+	rsync_dir_tree(args, split_list, source, dest)
+	_mark_done(split_list.state, 'dir_tree')
+	return
+
+# worker is a progress.WorkerProgress or None. If given rsync is asked for progress and
+# stats and its output is parsed while it runs. log_name as in rsync.RsyncOutput
+def _rsync_files_from(args, list_file_path, source, dest, worker = None, log_name = None):
 	rsync_args = args.copy()
-	rsync_args.append('--files-from=%s' % list_file_path[t_number])
+	rsync_args.append('--files-from=%s' % list_file_path)
 	rsync_args.append('--from0')
+	if worker is None:
+		rsync_args.append(source)
+		rsync_args.append(dest)
+		return check_rsync_output(rsync_args, log_name = log_name)
+	rsync_args += progress_rsync_args
 	rsync_args.append(source)
 	rsync_args.append(dest)
+	worker.start_rsync()
+	try:
+		stream_rsync_output(rsync_args, worker.feed, sep = b'\r', log_name = log_name)
+	finally:
+		worker.end_rsync()
+	return
+
+def __rsync_worker(t_number, args, list_file_path, source, dest, progress, state, errors):
+	if '--delete' in args:
+		raise ValueError('--delete option is forbidden during parallel rsync')
+	step = os.path.basename(list_file_path[t_number])
+	if _is_done(state, step):
+		return
+	worker = progress.worker(t_number) if progress is not None else None
 	#print('[Thread %d] starting rsync' % t_number)
-	(out, err) = check_rsync_output(rsync_args)
+	try:
+		_rsync_files_from(args, list_file_path[t_number], source, dest, worker, 'worker-%d' % t_number)
+	except RsyncError as e:
+		errors.append((list_file_path[t_number], e))
+		return
+	_mark_done(state, step)
 	#print('[Thread %d] rsync finished' % t_number)
 	return
 
-def prsync(args, split_list, source, dest):
+def _raise_list_errors(errors, what):
+	if len(errors) > 0:
+		raise RsyncError(
+				'%d rsync %s failed' % (len(errors), what),
+				'\n'.join('%s: %s' % (path, str(e)) for path, e in errors)
+		)
+	return
+
+# progress is a progress.ProgressMonitor or None
+def prsync(args, split_list, source, dest, progress = None):
 	if '--delete' in args:
 		raise ValueError('--delete option is forbidden during parallel rsync')
-	print('Syncing directory tree. This is a single process task')
-	rsync_dir_tree(args, split_list, source, dest)
-	threads = init_threads(split_list.nproc, __rsync_worker, (args, split_list.split_file_list, source, dest))
+	print('Syncing directory tree')
+	with phase(progress, 'dir_tree'):
+		_sync_dir_tree_once(args, split_list, source, dest)
+	if progress is not None:
+		for i in range(len(split_list.split_stats)):
+			progress.worker(i).total_bytes = split_list.split_stats[i][1]
+			progress.add_total(split_list.split_stats[i][1])
+	errors = []
+	threads = init_threads(split_list.nproc, __rsync_worker,
+			(args, split_list.split_file_list, source, dest, progress, split_list.state, errors))
 	print('Starting %d worker processes for %s' % (len(threads), 'file syncing'))
-	start_threads(threads)
-	join_threads(threads)
+	with phase(progress, 'transfer'):
+		start_threads(threads)
+		join_threads(threads)
+	_raise_list_errors(errors, 'processes')
+	return
+
+# nproc worker slots pulling batches (list files) from a shared queue as soon as they are
+# free, so a batch with slow files only keeps one slot busy instead of a whole static list
+class RsyncBatchScheduler():
+
+	def __init__(self, nproc, args, source, dest, progress = None, state = None):
+		if '--delete' in args:
+			raise ValueError('--delete option is forbidden during parallel rsync')
+		self.nproc = nproc
+		self.args = args
+		self.source = source
+		self.dest = dest
+		self.progress = progress
+		self.state = state
+		self.batch_queue = Queue()
+		self.batch_stats = []
+		self.errors = []
+		self.threads = []
+		self.start_time = None
+		self.lock = Lock()
+		self.active = 0
+		self.retire_requests = 0
+		self.done_bytes = 0
+
+	def _should_retire(self):
+		with self.lock:
+			if self.retire_requests > 0:
+				self.retire_requests -= 1
+				self.active -= 1
+				return True
+		return False
+
+	def _worker(self, t_number):
+		worker = self.progress.worker(t_number) if self.progress is not None else None
+		while True:
+			if self._should_retire():
+				break
+			batch = self.batch_queue.get()
+			if batch is None:
+				# leave it there for the other workers
+				self.batch_queue.put(None)
+				break
+			list_file_path, files, size = batch
+			step = os.path.basename(list_file_path)
+			if _is_done(self.state, step):
+				continue
+			start = time.time()
+			failed = False
+			# a failing batch must not stop the worker or the remaining batches will never
+			# be processed, errors are collected and reported at the end instead
+			try:
+				_rsync_files_from(self.args, list_file_path, self.source, self.dest, worker, 'worker-%d' % t_number)
+			except RsyncError as e:
+				failed = True
+				self.errors.append((list_file_path, e))
+			if not failed:
+				_mark_done(self.state, step)
+				self.done_bytes += size if size is not None else 0
+			self.batch_stats.append({
+					'batch': os.path.basename(list_file_path),
+					'worker': t_number,
+					'files': files,
+					'bytes': size,
+					'start': start - self.start_time,
+					'duration': time.time() - start,
+					'failed': failed,
+			})
+		return
+
+	def start(self):
+		self.start_time = time.time()
+		for i in range(self.nproc):
+			self.add_worker()
+		return
+
+	def add_worker(self):
+		with self.lock:
+			t = Thread(name = 'Working thread number %d' % len(self.threads), target = self._worker, args = (len(self.threads),))
+			self.threads.append(t)
+			self.active += 1
+		t.start()
+		return
+
+	# the worker leaves once done with its current batch. The last one is never retired
+	def retire_worker(self):
+		with self.lock:
+			if self.active - self.retire_requests <= 1:
+				return False
+			self.retire_requests += 1
+		return True
+
+	def workers(self):
+		with self.lock:
+			return self.active - self.retire_requests
+
+	def bytes_done(self):
+		if self.progress is not None:
+			return sum(w.bytes for w in list(self.progress.workers.values()))
+		return self.done_bytes
+
+	def submit(self, list_file_path, files = None, size = None):
+		if self.progress is not None and size is not None:
+			self.progress.add_total(size)
+		self.batch_queue.put((list_file_path, files, size))
+		return
+
+	# no point in finishing the queued batches if something went wrong upstream
+	def abort(self):
+		try:
+			while True:
+				self.batch_queue.get_nowait()
+		except Empty:
+			pass
+		return
+
+	# wait for the queued batches to be synced. No worker must be added from now on, stop any
+	# AdaptiveController first
+	def finish(self):
+		self.batch_queue.put(None)
+		while True:
+			with self.lock:
+				threads = list(self.threads)
+			if not any(t.is_alive() for t in threads):
+				break
+			join_threads(threads)
+		return
+
+	def check_errors(self):
+		_raise_list_errors(self.errors, 'batches')
+		return
+
+	def print_summary(self):
+		if len(self.batch_stats) == 0:
+			return
+		slowest = max(self.batch_stats, key = lambda b: b['duration'])
+		print('%d batches synced, slowest batch %s took %.1f seconds' % (
+				len(self.batch_stats), slowest['batch'], slowest['duration']))
+		return
+
+	def dump_report(self, path):
+		with open(path, 'w') as f:
+			json.dump(sorted(self.batch_stats, key = lambda b: b['start']), f, indent = 1)
+		return
+
+# Changes the number of workers of a RsyncBatchScheduler while it runs, between min_workers
+# and max_workers. Every interval seconds the aggregate throughput is sampled: a worker is
+# added as long as this improves the throughput, removed again if it doesn't. Workers are
+# also removed if the system load goes above the number of CPUs
+class AdaptiveController():
+
+	def __init__(self, min_workers, max_workers, interval = default_adapt_interval, threshold = 0.05, max_load = 1.0):
+		self.min_workers = min_workers
+		self.max_workers = max_workers
+		self.interval = interval
+		self.threshold = threshold
+		self.max_load = max_load
+		self.decisions = []
+		self.stop_event = Event()
+		self.thread = None
+		self.last_action = None
+		self.last_rate = None
+		self.hold = 0
+
+	def _decide(self, scheduler, rate, load):
+		workers = scheduler.workers()
+		if load > self.max_load and workers > self.min_workers:
+			return 'retire', 'system load %.2f per CPU' % load
+		if self.last_action == 'add' and self.last_rate is not None and rate < self.last_rate * (1 + self.threshold):
+			if workers > self.min_workers:
+				self.hold = 3
+				return 'retire', 'throughput did not improve with the last worker added'
+		if self.last_action == 'retire' and self.last_rate is not None and rate < self.last_rate * (1 - self.threshold):
+			if workers < self.max_workers:
+				self.hold = 3
+				return 'add', 'throughput dropped with the last worker removed'
+		if self.hold > 0:
+			self.hold -= 1
+			return None, 'holding'
+		if scheduler.batch_queue.qsize() == 0:
+			return None, 'no batch waiting'
+		if workers < self.max_workers and load < self.max_load:
+			return 'add', 'probing for more throughput'
+		return None, 'at the limit'
+
+	def _run(self, scheduler):
+		cpus = os.cpu_count() or 1
+		last_bytes = scheduler.bytes_done()
+		last_time = time.time()
+		while not self.stop_event.wait(self.interval):
+			now = time.time()
+			done = scheduler.bytes_done()
+			rate = (done - last_bytes) / (now - last_time)
+			load = os.getloadavg()[0] / cpus
+			action, reason = self._decide(scheduler, rate, load)
+			if action == 'add':
+				scheduler.add_worker()
+			elif action == 'retire' and not scheduler.retire_worker():
+				action = None
+			self.decisions.append({
+					'time': now - scheduler.start_time,
+					'rate': rate,
+					'load': load,
+					'workers': scheduler.workers(),
+					'action': action,
+					'reason': reason,
+			})
+			print('Adaptive workers: %.1f MB/s, load %.2f per CPU, %s -> %d workers (%s)' % (
+					rate / 1024**2, load, action if action is not None else 'no change', scheduler.workers(), reason))
+			# the effect of an action is evaluated only in the following round
+			self.last_action = action
+			self.last_rate = rate
+			last_bytes = done
+			last_time = now
+		return
+
+	def start(self, scheduler):
+		self.stop_event.clear()
+		self.thread = Thread(name = 'Adaptive controller', target = self._run, args = (scheduler,), daemon = True)
+		self.thread.start()
+		return
+
+	def stop(self):
+		if self.thread is not None:
+			self.stop_event.set()
+			self.thread.join()
+			self.thread = None
+		return
+
+# adaptive is an AdaptiveController or None
+def _run_batches(scheduler, dumper, feed_func, adaptive = None):
+	scheduler.start()
+	if adaptive is not None:
+		adaptive.start(scheduler)
+	try:
+		feed_func()
+		dumper.finish()
+	except BaseException:
+		scheduler.abort()
+		raise
+	finally:
+		# before the end of the queue is marked, the controller would count it as a batch
+		if adaptive is not None:
+			adaptive.stop()
+		scheduler.finish()
+	return
+
+# read the item list and cut it in many small batches instead of nproc big lists. Batches
+# are queued as soon as they are complete. With --files-from rsync creates the missing parent
+# directories itself, the directory tree is synced at the end so that directory metadata is
+# fixed after all files are in place. Splitting and syncing overlap and are recorded as a
+# single transfer phase in progress
+def prsync_queue(args, split_list, source, dest, batch_files = default_batch_files, batch_bytes = None, progress = None,
+		adaptive = None):
+	# splitting is deterministic, the batches of an interrupted run are generated again with
+	# the same content and the completed ones are skipped
+	scheduler = RsyncBatchScheduler(split_list.nproc, args, source, dest, progress, split_list.state)
+	dumper = SplitBatchDumper(split_list.nproc, split_list.split_func, split_list.tmpdir, scheduler.submit, batch_files, batch_bytes,
+			split_list.large_size, split_list.small_size)
+	print('Starting %d worker processes for %s' % (split_list.nproc, 'file syncing'))
+	with phase(progress, 'transfer'):
+		_run_batches(scheduler, dumper, lambda: split_list.feed_items(dumper.add_item), adaptive)
+	split_list.split_file_list = dumper.batch_list
+	split_list.dir_list_path = dumper.dir_list_path
+	split_list.large_list_path = dumper.large_list_path
+	split_list.small_list_path = dumper.small_list_path
+	scheduler.print_summary()
+	# always synced: resumed batches change the metadata of the directories again
+	print('Syncing directory tree')
+	with phase(progress, 'dir_tree'):
+		rsync_dir_tree(args, split_list, source, dest)
+	scheduler.check_errors()
+	return scheduler
+
+# generate the list and sync at the same time: the rsync dry run output is split in batches
+# while it is being read and the workers start as soon as the first batch is complete.
+# If delete_path is given the extraneous files found are written there, \0 separated.
+# generate_func is any function with the same signature as item_list.generate_list_stream.
+# List generation, splitting and syncing are recorded as a single transfer phase in progress
+def prsync_stream(args, split_list, source, dest, delete_path = None, batch_files = default_batch_files, batch_bytes = None,
+		generate_func = generate_list_stream, progress = None, adaptive = None):
+	gen_args = args[:]
+	if delete_path is not None:
+		gen_args.append('--delete')
+	scheduler = RsyncBatchScheduler(split_list.nproc, args, source, dest, progress)
+	dumper = SplitBatchDumper(split_list.nproc, split_list.split_func, split_list.tmpdir, scheduler.submit, batch_files, batch_bytes,
+			split_list.large_size, split_list.small_size)
+	print('Starting %d worker processes for %s while generating the list' % (split_list.nproc, 'file syncing'))
+	def feed():
+		with open(delete_path if delete_path is not None else os.devnull, 'wb') as delete_fd:
+			split_list.filter_feed(lambda item_func: generate_func(gen_args, source, dest, item_func,
+					lambda path: delete_fd.write(path + b'\0')))(dumper.add_item)
+	with phase(progress, 'transfer'):
+		_run_batches(scheduler, dumper, feed, adaptive)
+	split_list.split_file_list = dumper.batch_list
+	split_list.dir_list_path = dumper.dir_list_path
+	split_list.large_list_path = dumper.large_list_path
+	split_list.small_list_path = dumper.small_list_path
+	scheduler.print_summary()
+	print('List generation finished. Syncing directory tree')
+	with phase(progress, 'dir_tree'):
+		rsync_dir_tree(args, split_list, source, dest)
+	scheduler.check_errors()
+	return scheduler
+
+def _rsync_links_list(args, list_path, source, dest, state):
+	step = os.path.basename(list_path)
+	if _is_done(state, step) or os.path.getsize(list_path) == 0:
+		return
+	_rsync_files_from(args, list_path, source, dest, log_name = 'hard-links')
+	_mark_done(state, step)
+	return
+
+# sync the hard link lists written while splitting (see RsyncSplitList.hard_links) with up
+# to split_list.nproc rsync processes at the same time, one per list. args must contain
+# -H. The parents of the hard linked files are synced again at the end, to fix their
+# metadata as rsync_dir_tree does
+def prsync_hard_links(args, split_list, source, dest):
+	if '--delete' in args:
+		raise ValueError('--delete option is forbidden during parallel rsync')
+	errors = []
+	with ThreadPoolExecutor(max_workers = split_list.nproc, thread_name_prefix = 'links_worker_') as executor:
+		futures = [(path, executor.submit(_rsync_links_list, args, path, source, dest, split_list.state))
+				for path in split_list.links_list_paths]
+		for path, f in futures:
+			try:
+				f.result()
+			except RsyncError as e:
+				errors.append((path, e))
+	_raise_list_errors(errors, 'hard link lists')
+	if os.path.getsize(split_list.links_dir_list_path) > 0:
+		_rsync_dir_list(args, split_list.links_dir_list_path, source, dest)
+	return
+
+def _close_pipes(pipes, workers):
+	errors = []
+	for i in range(len(pipes)):
+		try:
+			pipes[i].close()
+		except RsyncError as e:
+			errors.append(('pipe %d' % i, e))
+		finally:
+			if workers[i] is not None:
+				workers[i].end_rsync()
+	return errors
+
+# like prsync, without any list on disk: every rsync process reads its list from a pipe
+# (--files-from=-) while the items are being split. feed_func is called with a function
+# taking (is_dir, size, path) and calls it for every item, e.g. wrapping
+# item_list.generate_list_stream or split.feed_item_list. Each pipe buffers at most
+# pipe_buffer bytes, then splitting waits for the slowest rsync process to catch up.
+# Directories are written to the list-dir list and synced by a single rsync at the end, to
+# fix their metadata after the files are in place and create the empty ones
+def prsync_pipe(args, split_list, source, dest, feed_func, pipe_buffer = default_pipe_buffer, progress = None):
+	if '--delete' in args:
+		raise ValueError('--delete option is forbidden during parallel rsync')
+	pipes = []
+	workers = []
+	failed = True
+	print('Starting %d worker processes for %s reading from pipes' % (split_list.nproc, 'file syncing'))
+	with phase(progress, 'transfer'):
+		try:
+			for i in range(split_list.nproc):
+				worker = progress.worker(i) if progress is not None else None
+				rsync_args = args + ['--files-from=-', '--from0']
+				if worker is not None:
+					rsync_args += progress_rsync_args
+				rsync_args += [source, dest]
+				pipes.append(RsyncPipe(rsync_args, pipe_buffer, worker.feed if worker is not None else None, b'\r',
+						log_name = 'worker-%d' % i))
+				if worker is not None:
+					worker.start_rsync()
+				workers.append(worker)
+			split_list.dir_list_path = split_list.tmpdir + '/list-dir'
+			with open(split_list.dir_list_path, 'wb') as dir_list:
+				split_items(split_list.filter_feed(feed_func), pipes, split_list.split_func, dir_list, split_list.split_stats)
+			failed = False
+		finally:
+			if failed:
+				for p in pipes:
+					p.kill()
+			errors = _close_pipes(pipes, workers)
+	_raise_list_errors(errors, 'processes')
+	print('Syncing directory tree')
+	with phase(progress, 'dir_tree'):
+		_rsync_dir_list(args, split_list.dir_list_path, source, dest)
 	return
 
 def __print_rm_error(function, path, excinfo):
@@ -141,59 +678,228 @@ def __print_rm_error(function, path, excinfo):
 		return
 	print('Error while removing %s: %s' % (path, str(excpt)))
 
-# we remove only the files to avoid the different thread worker to fight each other unnecessarily removing directories
-# recursively. Instead we save the directory list to be removed for later and we remove those later
-# not doing so can also cause problems on some file systems such as NFS, which is not POSIX and might throw a 
-# stale file error if multiple threads are trying to remove it in parallel
-def __rm_worker(files_list):
-	dir_list = []
-	for file_path in files_list:
-		try:
-			os.unlink(file_path)
-		except IsADirectoryError:
-			# shutil.rmtree(file_path, False, __print_rm_error)
-			dir_list.append(file_path)
-		except OSError as e:
-			if e.errno != errno.ENOENT:
-				raise e
-	return dir_list
+def _open_dir(path):
+	return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+def _group_by_parent(paths):
+	by_parent = {}
+	for path in paths:
+		parent, name = os.path.split(path)
+		by_parent.setdefault(parent, []).append(name)
+	return by_parent.items()
 
 batch_size = 1000
-def __batch_rm_files(item, dest, executor, last = False):
-	# if last == True we might not have another item, we just want to start processing the remaining items in the batch
-	if item is not None:
-		__batch_rm_files.next_batch.append(dest + b'/' + item)
-	if len(__batch_rm_files.next_batch) >= batch_size or last:
-		f = __submit2executor(__batch_rm_files.next_batch, executor)
-		__batch_rm_files.next_batch = []
-		__batch_rm_files.futures.append(f)
-	return
-# static variable initialization trick
-__batch_rm_files.next_batch = []
-__batch_rm_files.futures = []
 
-def __submit2executor(item_list, executor):
-	return executor.submit(__rm_worker, item_list)
+# Removes the files and directories listed in a delete list, paths relative to dest.
+# Files are unlinked by a pool of threads in batches. We remove only the files at first to
+# avoid the different thread workers to fight each other unnecessarily removing directories
+# recursively. Not doing so can also cause problems on some file systems such as NFS, which
+# is not POSIX and might throw a stale file error if multiple threads are trying to remove
+# it in parallel. Directories are removed afterwards, in parallel one depth level at a time
+# starting from the deepest one, so a directory is always empty when we get to it.
+# Each batch opens the parent directory once and works relative to its file descriptor,
+# saving the path resolution of every entry on deep trees
+class ParallelRemover():
 
-# TODO add handlers for SIGINT / SIGTERM etc to shutdown the executor without waiting
+	def __init__(self, nthreads, dest, batch_size = batch_size):
+		self.nthreads = nthreads
+		self.dest = dest
+		self.batch_size = batch_size
+		self.next_batch = []
+		self.futures = []
+		self.files_removed = 0
+		self.dirs_removed = 0
+		self.files_time = 0
+		self.dirs_time = 0
+
+	def _rm_files(self, batch):
+		removed = 0
+		dir_list = []
+		for parent, names in _group_by_parent(batch):
+			try:
+				dir_fd = _open_dir(self.dest + b'/' + parent)
+			except FileNotFoundError:
+				continue
+			try:
+				for name in names:
+					try:
+						os.unlink(name, dir_fd = dir_fd)
+						removed += 1
+					except IsADirectoryError:
+						dir_list.append(os.path.join(parent, name))
+					except OSError as e:
+						if e.errno != errno.ENOENT:
+							raise e
+			finally:
+				os.close(dir_fd)
+		return removed, dir_list
+
+	def _rm_dirs(self, batch):
+		removed = 0
+		for parent, names in _group_by_parent(batch):
+			try:
+				dir_fd = _open_dir(self.dest + b'/' + parent)
+			except FileNotFoundError:
+				continue
+			try:
+				for name in names:
+					try:
+						os.rmdir(name, dir_fd = dir_fd)
+						removed += 1
+					except OSError as e:
+						if e.errno != errno.ENOENT:
+							raise e
+			finally:
+				os.close(dir_fd)
+		return removed
+
+	def _add(self, item, executor):
+		# rsync lists directories with a trailing slash
+		self.next_batch.append(item.rstrip(b'/'))
+		if len(self.next_batch) >= self.batch_size:
+			self._flush(executor)
+		return
+
+	def _flush(self, executor):
+		if len(self.next_batch) > 0:
+			self.futures.append(executor.submit(self._rm_files, self.next_batch))
+			self.next_batch = []
+		return
+
+	def _remove_dirs(self, dir_list, executor):
+		levels = {}
+		for dir_p in dir_list:
+			levels.setdefault(dir_p.count(b'/'), []).append(dir_p)
+		for depth in sorted(levels, reverse = True):
+			level = sorted(levels[depth])
+			futures = [executor.submit(self._rm_dirs, level[i:i + self.batch_size])
+					for i in range(0, len(level), self.batch_size)]
+			for f in futures:
+				self.dirs_removed += f.result()
+		return
+
+	# TODO add handlers for SIGINT / SIGTERM etc to shutdown the executor without waiting
+	def run(self, delete_list):
+		self._run(lambda executor: read_list_process_line(delete_list, b'\0', self._add, (executor,)))
+		return
+
+	def _run(self, feed_func):
+		self.next_batch = []
+		self.futures = []
+		with profiled('delete'), ThreadPoolExecutor(max_workers = self.nthreads, thread_name_prefix = 'rm_worker_') as executor:
+			start = time.time()
+			feed_func(executor)
+			self._flush(executor)
+			dir_list = []
+			for f in self.futures:
+				removed, dirs = f.result()
+				self.files_removed += removed
+				dir_list += dirs
+			self.futures = []
+			self.files_time += time.time() - start
+			print('Worker threads finished removing %d files in %.1f seconds, now removing the remaining %d folders' % (
+					self.files_removed, self.files_time, len(dir_list)))
+			start = time.time()
+			self._remove_dirs(dir_list, executor)
+			self.dirs_time += time.time() - start
+		print('Removed %d folders in %.1f seconds' % (self.dirs_removed, self.dirs_time))
+		return
+
+	def stats(self):
+		return {
+				'files_removed': self.files_removed,
+				'files_time': self.files_time,
+				'dirs_removed': self.dirs_removed,
+				'dirs_time': self.dirs_time,
+		}
+
+# delete_list is the path of a \0 separated list of paths relative to dest
 def prm(n, delete_list, dest):
 	print('Starting worker threads for removing leftover files')
-	global executor
-	with ThreadPoolExecutor(thread_name_prefix = 'rm_worker_') as executor:
-		read_list_process_line(delete_list, b'\0', __batch_rm_files, (dest, executor))
-		__batch_rm_files(None, None, executor, True)
-		futures = __batch_rm_files.futures
-		dir_list = []
-		for f in futures:
-			dir_list += f.result()
-	
-	dir_list.sort(reverse = True)
-	print('Worker threads finished removing files, now removing the remaining %d folders' % len(dir_list))
-	for dir_p in dir_list:
-		# shutil.rmtree(dir_p, False, __print_rm_error)
-		try:
-			os.rmdir(dir_p)
-		except OSError as e:
-			if e.errno != errno.ENOENT:
-				raise e
-	return
+	remover = ParallelRemover(n, dest)
+	remover.run(delete_list)
+	return remover
+
+def _delete_dirs(source, depth):
+	top = [b'']
+	level = [b'']
+	for d in range(depth):
+		next_level = []
+		for rel in level:
+			with os.scandir(source + rel) as it:
+				for entry in it:
+					if entry.is_dir(follow_symlinks = False):
+						next_level.append(rel + entry.name + b'/')
+		if d < depth - 1:
+			top += next_level
+		level = next_level
+	return top, level
+
+# Deletes the files in dest which are not in source with rsync, as a final
+# rsync --delete --existing --ignore-existing would do, splitting the trees in the subtrees
+# rooted depth levels below source and running up to nthreads rsync processes at the same
+# time, one per subtree. The directories above the subtrees are handled without recursion,
+# removing only what they directly contain. Used when the delete list is not available, e.g.
+# with --files-from. Filter rules are not allowed: each rsync has a subtree as root, so
+# anchored rules would match other paths than in a single rsync
+class SubtreeDeleter():
+
+	def __init__(self, nthreads, args, source, dest, depth = 1):
+		if depth < 1:
+			raise ValueError('the delete split depth must be at least 1')
+		if has_filter_rules(args):
+			raise ValueError('filter rules are not supported when deleting by subtree')
+		self.nthreads = nthreads
+		self.args = args + ['--delete', '--existing', '--ignore-existing', '--out-format=%i %n']
+		self.source = source
+		self.dest = dest
+		self.depth = depth
+		self.subtrees = 0
+		self.deleted = 0
+		self.errors = []
+		self.elapsed = 0
+
+	def _rsync(self, rel, recursive):
+		dest = self.dest.rstrip(b'/') + b'/' + rel
+		if not os.path.isdir(dest) or os.path.islink(dest.rstrip(b'/')):
+			# nothing to delete in there
+			return 0
+		args = self.args if recursive else self.args + ['--no-recursive', '--dirs']
+		deleted = [0]
+		def count(line):
+			if line.startswith(b'*deleting'):
+				deleted[0] += 1
+			return
+		stream_rsync_output(args + [self.source + rel, dest], count, role = 'delete')
+		return deleted[0]
+
+	def run(self):
+		start = time.time()
+		top, subtrees = _delete_dirs(self.source, self.depth)
+		with ThreadPoolExecutor(max_workers = self.nthreads, thread_name_prefix = 'delete_worker_') as executor:
+			futures = [(rel, executor.submit(self._rsync, rel, False)) for rel in top]
+			futures += [(rel, executor.submit(self._rsync, rel, True)) for rel in subtrees]
+			for rel, f in futures:
+				try:
+					self.deleted += f.result()
+				except RsyncError as e:
+					self.errors.append((os.fsdecode(rel) if rel != b'' else '.', e))
+		self.subtrees = len(top) + len(subtrees)
+		self.elapsed = time.time() - start
+		print('Deleted %d extraneous entries from %d subtrees in %.1f seconds' % (self.deleted, self.subtrees, self.elapsed))
+		_raise_list_errors(self.errors, 'delete subtrees')
+		return
+
+	def stats(self):
+		return {
+				'subtrees': self.subtrees,
+				'deleted': self.deleted,
+				'failed_subtrees': len(self.errors),
+				'time': self.elapsed,
+		}
+
+def prsync_delete(n, args, source, dest, depth = 1):
+	print('Starting %d rsync processes to delete extraneous files from dest' % n)
+	deleter = SubtreeDeleter(n, args, source, dest, depth)
+	deleter.run()
+	return deleter
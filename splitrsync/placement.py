@@ -0,0 +1,134 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Where and how the rsync processes run: the CPUs they are allowed on, one NUMA node each
+# in round robin, and their CPU and I/O priority. The priority depends on the role of the
+# process: the transfer workers, or the list generation and delete passes
+
+import os
+import shutil
+
+from subprocess import Popen as popen
+from threading import Lock
+
+node_sys_path = '/sys/devices/system/node'
+ionice_classes = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+roles = ['transfer', 'list', 'delete']
+
+# parse a kernel CPU list, e.g. 0-3,8,10-11
+def parse_cpu_list(text):
+	cpus = set()
+	for part in text.strip().split(','):
+		if part == '':
+			continue
+		first, sep, last = part.partition('-')
+		cpus.update(range(int(first), int(last if sep != '' else first) + 1))
+	return cpus
+
+# the CPUs of each NUMA node, only those this process is allowed to run on. nodes restricts
+# them to the given node numbers. Without NUMA information all the allowed CPUs are a
+# single set
+def numa_cpusets(nodes = None, sys_path = node_sys_path):
+	allowed = os.sched_getaffinity(0)
+	try:
+		available = sorted(int(n[4:]) for n in os.listdir(sys_path) if n.startswith('node') and n[4:].isdigit())
+	except FileNotFoundError:
+		available = []
+	if nodes is not None:
+		missing = [n for n in nodes if n not in available]
+		if len(missing) > 0:
+			raise ValueError('NUMA nodes %s not found in %s' % (', '.join(str(n) for n in missing), sys_path))
+		available = nodes
+	cpusets = []
+	for node in available:
+		with open(os.path.join(sys_path, 'node%d' % node, 'cpulist')) as f:
+			cpus = parse_cpu_list(f.read()) & allowed
+		if len(cpus) > 0:
+			cpusets.append(cpus)
+	if len(cpusets) == 0:
+		if nodes is not None:
+			raise ValueError('no usable CPU on NUMA nodes %s' % ', '.join(str(n) for n in nodes))
+		cpusets.append(allowed)
+	return cpusets
+
+# CLASS or CLASS:LEVEL, e.g. idle or best-effort:7. Returns a (class, level) pair, level is
+# None if not given
+def parse_ionice(value):
+	name, sep, level = value.partition(':')
+	if name not in ionice_classes:
+		raise ValueError('unknown I/O scheduling class %s, valid classes are: %s' % (name, ', '.join(ionice_classes)))
+	if sep == '':
+		return (name, None)
+	if name == 'idle':
+		raise ValueError('the idle I/O scheduling class has no level')
+	level = int(level)
+	if level < 0 or level > 7:
+		raise ValueError('I/O scheduling level must be between 0 and 7')
+	return (name, level)
+
+def priority_prefix(nice = None, ionice = None):
+	prefix = []
+	if nice is not None:
+		prefix += ['nice', '-n', str(nice)]
+	if ionice is not None:
+		if shutil.which('ionice') is None:
+			raise ValueError('ionice not found, cannot set the I/O priority')
+		prefix += ['ionice', '-c', str(ionice_classes[ionice[0]])]
+		if ionice[1] is not None:
+			prefix += ['-n', str(ionice[1])]
+	return prefix
+
+# cpusets is a list of sets of CPUs, every process started is given the next one, round
+# robin. None leaves the processes where the kernel wants. priorities maps a role to a
+# (nice, ionice) pair as accepted by priority_prefix
+class Placement():
+
+	def __init__(self, cpusets = None, priorities = None):
+		if priorities is None:
+			priorities = {}
+		for role in priorities:
+			if role not in roles:
+				raise ValueError('unknown process role %s, valid roles are: %s' % (role, ', '.join(roles)))
+		self.cpusets = cpusets
+		self.prefixes = dict((role, priority_prefix(*p)) for role, p in priorities.items())
+		self.next_set = 0
+		self.lock = Lock()
+
+	def _next_cpus(self):
+		with self.lock:
+			cpus = self.cpusets[self.next_set]
+			self.next_set = (self.next_set + 1) % len(self.cpusets)
+		return cpus
+
+	def popen(self, cmd, role = 'transfer', **kwargs):
+		cmd = self.prefixes.get(role, []) + cmd
+		if self.cpusets is None:
+			return popen(cmd, **kwargs)
+		# the child inherits the affinity of the thread forking it, change it just for
+		# the fork. A preexec_fn would do the same in the child, but it is not safe when
+		# other threads are running, which is always the case here
+		cpus = self._next_cpus()
+		old = os.sched_getaffinity(0)
+		os.sched_setaffinity(0, cpus)
+		try:
+			return popen(cmd, **kwargs)
+		finally:
+			os.sched_setaffinity(0, old)
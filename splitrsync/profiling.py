@@ -0,0 +1,121 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Where the time goes on the Python side: the sections doing work in Python (parsing the
+# rsync output, splitting the list, removing files) are wrapped with profiled(name). They
+# cost nothing unless a Profiler is set in profiler
+
+import cProfile
+import io
+import pstats
+import sys
+import time
+
+from contextlib import contextmanager
+from threading import Lock, local
+
+profile_modes = ['time', 'cprofile']
+report_functions = 30
+
+# a Profiler or None
+profiler = None
+
+class _Section():
+
+	def __init__(self):
+		self.calls = 0
+		self.time = 0
+		self.stats = None
+
+# mode time only measures how long each section takes, cprofile runs the Python profiler
+# as well. cProfile sees only the thread entering the section, work done by thread pools
+# in the section is counted in its time but not in its profile. Nested sections are only
+# timed
+class Profiler():
+
+	def __init__(self, mode = 'time'):
+		if mode not in profile_modes:
+			raise ValueError('unknown profile mode %s, valid modes are: %s' % (mode, ', '.join(profile_modes)))
+		self.mode = mode
+		self.sections = {}
+		self.lock = Lock()
+		self.active = local()
+
+	@contextmanager
+	def section(self, name):
+		profile = None
+		if self.mode == 'cprofile' and not getattr(self.active, 'profiling', False):
+			profile = cProfile.Profile()
+			self.active.profiling = True
+			profile.enable()
+		start = time.time()
+		try:
+			yield
+		finally:
+			elapsed = time.time() - start
+			if profile is not None:
+				profile.disable()
+				self.active.profiling = False
+			with self.lock:
+				section = self.sections.setdefault(name, _Section())
+				section.calls += 1
+				section.time += elapsed
+				if profile is not None:
+					if section.stats is None:
+						section.stats = pstats.Stats(profile)
+					else:
+						section.stats.add(profile)
+		return
+
+	def report(self):
+		return dict((name, {'calls': s.calls, 'time': s.time}) for name, s in self.sections.items())
+
+	def print_report(self, out = sys.stdout):
+		print('Python side profile:', file = out)
+		for name, s in sorted(self.sections.items(), key = lambda item: item[1].time, reverse = True):
+			print('    %-20s %6d calls %10.2fs' % (name, s.calls, s.time), file = out)
+		for name, s in self.sections.items():
+			if s.stats is None:
+				continue
+			text = io.StringIO()
+			s.stats.stream = text
+			s.stats.sort_stats('cumulative').print_stats(report_functions)
+			print('\nProfile of %s:\n%s' % (name, text.getvalue()), file = out)
+		return
+
+	# the text report to path, with cprofile the raw statistics of each section to
+	# path.<section>.prof as well, to be loaded with pstats
+	def dump_report(self, path):
+		with open(path, 'w') as f:
+			self.print_report(f)
+		for name, s in self.sections.items():
+			if s.stats is not None:
+				s.stats.dump_stats('%s.%s.prof' % (path, name))
+		return
+
+@contextmanager
+def _no_section():
+	yield
+
+def profiled(name):
+	if profiler is None:
+		return _no_section()
+	return profiler.section(name)
@@ -0,0 +1,237 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Live progress of the rsync workers, parsed from --info=progress2 and --stats while the
+# processes run, and a JSON report with the timing of each phase and each worker
+
+import json
+import re
+import sys
+import time
+
+from contextlib import contextmanager
+from threading import Thread, Event, Lock
+
+progress_rsync_args = ['--info=progress2', '--stats']
+default_interval = 10
+
+# e.g.:      1,238,099  45%   10.00MB/s    0:00:12 (xfr#3, to-chk=10/20)
+progress2_re = re.compile(br'^\s*(?P<bytes>[\d,]+)\s+\d+%\s+\S+\s+\S+(?:\s+\(xfr#(?P<files>\d+),)?')
+stats_files_re = re.compile(br'^Number of regular files transferred: (?P<files>[\d,]+)')
+stats_bytes_re = re.compile(br'^Total transferred file size: (?P<bytes>[\d,]+) bytes')
+
+def _to_int(num):
+	return int(num.replace(b',', b''))
+
+def _format_bytes(size):
+	for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+		if size < 1024 or unit == 'TB':
+			return '%.1f %s' % (size, unit)
+		size /= 1024
+
+def _format_eta(seconds):
+	if seconds is None:
+		return '--:--:--'
+	seconds = int(seconds)
+	return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class WorkerProgress():
+
+	def __init__(self, number):
+		self.number = number
+		self.total_bytes = 0
+		self.done_bytes = 0
+		self.done_files = 0
+		self.current_bytes = 0
+		self.current_files = 0
+		self.rsync_runs = 0
+		self.busy_time = 0
+		self.start_time = None
+		self.last_bytes = 0
+		self.rate = 0
+
+	@property
+	def bytes(self):
+		return self.done_bytes + self.current_bytes
+
+	@property
+	def files(self):
+		return self.done_files + self.current_files
+
+	def start_rsync(self):
+		self.start_time = time.time()
+		self.current_bytes = 0
+		self.current_files = 0
+		return
+
+	def end_rsync(self):
+		self.done_bytes += self.current_bytes
+		self.done_files += self.current_files
+		self.current_bytes = 0
+		self.current_files = 0
+		self.rsync_runs += 1
+		self.busy_time += time.time() - self.start_time
+		self.start_time = None
+		return
+
+	# rsync output with --info=progress2 separates progress updates with \r, the --stats
+	# report comes with \n. Lines are split on \r by the reader, split again on \n here
+	def feed(self, chunk):
+		for line in chunk.split(b'\n'):
+			m = progress2_re.match(line)
+			if m is not None:
+				self.current_bytes = _to_int(m.group('bytes'))
+				if m.group('files') is not None:
+					self.current_files = int(m.group('files'))
+				continue
+			m = stats_files_re.match(line)
+			if m is not None:
+				self.current_files = _to_int(m.group('files'))
+				continue
+			m = stats_bytes_re.match(line)
+			if m is not None:
+				self.current_bytes = _to_int(m.group('bytes'))
+		return
+
+	def report(self):
+		return {
+				'worker': self.number,
+				'bytes': self.bytes,
+				'files': self.files,
+				'rsync_runs': self.rsync_runs,
+				'busy_time': self.busy_time,
+		}
+
+class ProgressMonitor():
+
+	def __init__(self, interval = default_interval, live = True, out = sys.stdout):
+		self.interval = interval
+		self.live = live
+		self.out = out
+		self.workers = {}
+		self.phases = {}
+		self.total_bytes = 0
+		self.lock = Lock()
+		self.stop_event = Event()
+		self.thread = None
+		self.last_time = None
+		self.last_bytes = 0
+
+	def worker(self, number):
+		with self.lock:
+			if number not in self.workers:
+				self.workers[number] = WorkerProgress(number)
+			return self.workers[number]
+
+	# the expected amount of data, used for the ETA. Can grow while the list is generated
+	def add_total(self, size):
+		with self.lock:
+			self.total_bytes += size
+		return
+
+	@contextmanager
+	def phase(self, name):
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.phases[name] = {'start': start, 'duration': time.time() - start}
+		return
+
+	def _print_status(self):
+		now = time.time()
+		workers = list(self.workers.values())
+		total = sum(w.bytes for w in workers)
+		files = sum(w.files for w in workers)
+		rate = 0
+		if self.last_time is not None and now > self.last_time:
+			rate = (total - self.last_bytes) / (now - self.last_time)
+		eta = None
+		if rate > 0 and self.total_bytes > total:
+			eta = (self.total_bytes - total) / rate
+		elif self.total_bytes > 0 and total >= self.total_bytes:
+			eta = 0
+		print('[%s] %s done, %d files, %.2f GB/s, ETA %s' % (
+				time.strftime('%H:%M:%S'), _format_bytes(total), files, rate / 1024**3, _format_eta(eta)),
+				file = self.out)
+		for w in workers:
+			w_rate = 0
+			if self.last_time is not None and now > self.last_time:
+				w_rate = (w.bytes - w.last_bytes) / (now - self.last_time)
+			w.last_bytes = w.bytes
+			w.rate = w_rate
+			w_eta = None
+			if w_rate > 0 and w.total_bytes > w.bytes:
+				w_eta = (w.total_bytes - w.bytes) / w_rate
+			print('    worker %d: %s, %d files, %s/s, ETA %s' % (
+					w.number, _format_bytes(w.bytes), w.files, _format_bytes(w_rate), _format_eta(w_eta)),
+					file = self.out)
+		self.out.flush()
+		self.last_time = now
+		self.last_bytes = total
+		return
+
+	def _run(self):
+		self.last_time = time.time()
+		while not self.stop_event.wait(self.interval):
+			self._print_status()
+		return
+
+	def start(self):
+		if self.live and self.thread is None:
+			self.stop_event.clear()
+			self.thread = Thread(name = 'Progress monitor', target = self._run, daemon = True)
+			self.thread.start()
+		return
+
+	def stop(self):
+		if self.thread is not None:
+			self.stop_event.set()
+			self.thread.join()
+			self.thread = None
+			self._print_status()
+		return
+
+	def report(self):
+		return {
+				'phases': self.phases,
+				'workers': [self.workers[n].report() for n in sorted(self.workers)],
+				'total_bytes': sum(w.bytes for w in self.workers.values()),
+				'total_files': sum(w.files for w in self.workers.values()),
+		}
+
+	def dump_report(self, path, extra = None):
+		report = self.report()
+		if extra is not None:
+			report.update(extra)
+		with open(path, 'w') as f:
+			json.dump(report, f, indent = 1)
+		return
+
+@contextmanager
+def _no_phase():
+	yield
+
+# progress may be None, in which case nothing is recorded
+def phase(progress, name):
+	if progress is None:
+		return _no_phase()
+	return progress.phase(name)
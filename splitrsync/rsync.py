@@ -19,12 +19,27 @@
 #                                                                            #
 ##############################################################################
 
+from collections import deque
+from queue import Queue
 from subprocess import Popen as popen, PIPE, STDOUT, DEVNULL
+from threading import Thread, Lock
 
+import os
 import sys
 
+from . import default_buffer_size
+
 rsync_cmd = b'rsync'
 rsync_copts = []  # cannot put -q here, will silence the --itemize output
+# a placement.Placement or None, used to start every rsync process
+placement = None
+# if not None the output of every rsync process is written to a log file in log_dir, see
+# RsyncOutput. Logs are rotated when bigger than log_max_bytes, keeping log_backups old ones
+log_dir = None
+log_max_bytes = 64 * 1024**2 # 64MB
+log_backups = 3
+# lines of standard output and error kept in memory for each rsync process
+default_tail_lines = 100
 
 class RsyncError(Exception):
 	# output is just the (guessed) relevant part for the error, not the whole
@@ -39,18 +54,106 @@ class RsyncError(Exception):
 			out += '\n\nRsync output / error:\n%s\n\n' % self.output
 		return out
 
-def check_rsync_output(args):
-	try:
-		#print('calling: rsync ' + ' '.join(args))
-		rsync = popen(basic_rsync_cmd() + args, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
-		(out, err) = rsync.communicate()
-		rsync.wait()
-	except (OSError,IOError) as e:
-		raise RsyncError(str(e))
-	out = out.decode()
-	err = err.decode()
-	if rsync.returncode != 0:
-		raise RsyncError('rsync process terminated with returncode %d' % rsync.returncode, err)
+# a log file shared by all the processes logging with the same name, rotated as
+# logging.handlers.RotatingFileHandler does: name.log is renamed name.log.1 and so on
+class RotatingLog():
+
+	def __init__(self, path, max_bytes = log_max_bytes, backups = log_backups):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.lock = Lock()
+		self.fd = open(path, 'ab')
+
+	def _rotate(self):
+		self.fd.close()
+		for i in range(self.backups - 1, 0, -1):
+			if os.path.exists('%s.%d' % (self.path, i)):
+				os.replace('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+		if self.backups > 0:
+			os.replace(self.path, self.path + '.1')
+		self.fd = open(self.path, 'wb')
+		return
+
+	def write(self, data):
+		with self.lock:
+			if self.fd.tell() + len(data) > self.max_bytes and self.fd.tell() > 0:
+				self._rotate()
+			self.fd.write(data)
+		return
+
+	def close(self):
+		with self.lock:
+			self.fd.close()
+		return
+
+_logs = {}
+_logs_lock = Lock()
+
+def _get_log(name):
+	with _logs_lock:
+		if name not in _logs:
+			_logs[name] = RotatingLog(os.path.join(log_dir, name + '.log'), log_max_bytes, log_backups)
+		return _logs[name]
+
+def close_logs():
+	with _logs_lock:
+		for log in _logs.values():
+			log.close()
+		_logs.clear()
+	return
+
+# the output of a rsync process, read line by line while it runs. Only the last tail_lines
+# lines of standard output and error are kept in memory, for the error reports, every line
+# is written to the log log_name in log_dir if set
+class RsyncOutput():
+
+	def __init__(self, args, log_name, tail_lines = default_tail_lines):
+		self.log = _get_log(log_name) if log_dir is not None else None
+		self.out = deque(maxlen = tail_lines)
+		self.err = deque(maxlen = tail_lines)
+		self.out_lines = 0
+		self.err_lines = 0
+		if self.log is not None:
+			self.log.write(b'$ ' + b' '.join(os.fsencode(a) for a in args) + b'\n')
+
+	def out_line(self, line):
+		self.out.append(line)
+		self.out_lines += 1
+		if self.log is not None:
+			self.log.write(line + b'\n')
+		return
+
+	# a line function writing every line to the log and the tail before handing it to
+	# line_func
+	def tee(self, line_func):
+		def out_line(line):
+			self.out_line(line)
+			line_func(line)
+			return
+		return out_line
+
+	def err_line(self, line):
+		self.err.append(line)
+		self.err_lines += 1
+		if self.log is not None:
+			self.log.write(b'stderr: ' + line + b'\n')
+		return
+
+	def _tail(self, lines, count):
+		text = b'\n'.join(lines).decode(errors = 'replace')
+		if count > len(lines):
+			text = '(%d lines not shown%s)\n%s' % (count - len(lines),
+					', see the logs in %s' % log_dir if log_dir is not None else '', text)
+		return text
+
+	def stdout(self):
+		return self._tail(self.out, self.out_lines)
+
+	def stderr(self):
+		return self._tail(self.err, self.err_lines)
+
+def _print_rsync_stderr(err):
 	if err is not None and err != '':
 		print('WARNING: rsync output found on standard error:', file=sys.stderr)
 		for line in err.split('\n'):
@@ -58,7 +161,177 @@ def check_rsync_output(args):
 				continue
 			print('rsync standard error: %s' % line, file=sys.stderr)
 		print('', file=sys.stderr)
+	return
+
+def _read_lines(fd, line_func, sep):
+	next_line = b''
+	for buf in iter(lambda: fd.read1(default_buffer_size), b''):
+		s = buf.split(sep)
+		s[0] = next_line + s[0]
+		for i in range(len(s) - 1):
+			line_func(s[i])
+		next_line = s[len(s) - 1]
+	if next_line != b'':
+		line_func(next_line)
+	return
+
+# role is the kind of work of the process, see placement.roles
+def _popen(args, role, **kwargs):
+	if placement is None:
+		return popen(basic_rsync_cmd() + args, **kwargs)
+	return placement.popen(basic_rsync_cmd() + args, role, **kwargs)
+
+def check_rsync_output(args, role = 'transfer', log_name = None):
+	output = RsyncOutput(args, log_name if log_name is not None else role)
+	try:
+		#print('calling: rsync ' + ' '.join(args))
+		rsync = _popen(args, role, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+	except (OSError,IOError) as e:
+		raise RsyncError(str(e))
+	err_thread = Thread(name = 'rsync stderr reader', target = _read_lines, args = (rsync.stderr, output.err_line, b'\n'))
+	err_thread.start()
+	try:
+		_read_lines(rsync.stdout, output.out_line, b'\n')
+	finally:
+		rsync.stdout.close()
+		rsync.wait()
+		err_thread.join()
+		rsync.stderr.close()
+	out = output.stdout()
+	err = output.stderr()
+	if rsync.returncode != 0:
+		raise RsyncError('rsync process terminated with returncode %d' % rsync.returncode, err)
+	_print_rsync_stderr(err)
 	return (out, err)
 
+# like check_rsync_output but the standard output is handed to line_func as well: it is
+# read as bytes while rsync is still running and line_func is called for every line as soon
+# as it is complete. Standard error is read by a separate thread to avoid dead locks
+def stream_rsync_output(args, line_func, sep = b'\n', role = 'transfer', log_name = None):
+	output = RsyncOutput(args, log_name if log_name is not None else role)
+	line_func = output.tee(line_func)
+	try:
+		rsync = _popen(args, role, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+	except (OSError,IOError) as e:
+		raise RsyncError(str(e))
+	err_thread = Thread(name = 'rsync stderr reader', target = _read_lines, args = (rsync.stderr, output.err_line, b'\n'))
+	err_thread.start()
+	try:
+		next_line = b''
+		buf = rsync.stdout.read1(default_buffer_size)
+		while len(buf) > 0:
+			s = buf.split(sep)
+			s[0] = next_line + s[0]
+			for i in range(len(s) - 1):
+				line_func(s[i])
+			next_line = s[len(s) - 1]
+			buf = rsync.stdout.read1(default_buffer_size)
+		if next_line != b'':
+			line_func(next_line)
+	except BaseException:
+		# the consumer failed, do not leave rsync running
+		rsync.kill()
+		raise
+	finally:
+		rsync.stdout.close()
+		rsync.wait()
+		err_thread.join()
+		rsync.stderr.close()
+	err = output.stderr()
+	if rsync.returncode != 0:
+		raise RsyncError('rsync process terminated with returncode %d' % rsync.returncode, err)
+	_print_rsync_stderr(err)
+	return err
+
+default_pipe_buffer = 16 * 1024**2 # 16MB
+
+# a rsync process reading its file list from the standard input (args must contain
+# --files-from=-). Written data is collected in chunks of default_buffer_size and handed to
+# a writer thread through a queue holding at most buffer_size bytes: when rsync is slower
+# than the producer write() blocks until rsync catches up.
+# If line_func is given it is called for every line of the standard output, split on sep,
+# after the line is written to the log
+class RsyncPipe():
+
+	def __init__(self, args, buffer_size = default_pipe_buffer, line_func = None, sep = b'\n', role = 'transfer',
+			log_name = None):
+		self.chunk_size = min(default_buffer_size, buffer_size)
+		self.chunks = Queue(max(1, buffer_size // self.chunk_size))
+		self.next_chunk = []
+		self.next_size = 0
+		self.output = RsyncOutput(args, log_name if log_name is not None else role)
+		self.write_error = None
+		try:
+			self.rsync = _popen(args, role, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+		except (OSError,IOError) as e:
+			raise RsyncError(str(e))
+		if line_func is None:
+			line_func, sep = self.output.out_line, b'\n'
+		else:
+			line_func = self.output.tee(line_func)
+		self.threads = [
+			Thread(name = 'rsync stdin writer', target = self._writer),
+			Thread(name = 'rsync stdout reader', target = _read_lines, args = (self.rsync.stdout, line_func, sep)),
+			Thread(name = 'rsync stderr reader', target = _read_lines, args = (self.rsync.stderr, self.output.err_line, b'\n')),
+		]
+		for t in self.threads:
+			t.start()
+
+	def _writer(self):
+		for chunk in iter(self.chunks.get, None):
+			if self.write_error is not None:
+				# rsync is gone, keep consuming so the producer never blocks forever
+				continue
+			try:
+				self.rsync.stdin.write(chunk)
+			except (OSError,IOError) as e:
+				self.write_error = e
+		try:
+			self.rsync.stdin.close()
+		except (OSError,IOError):
+			pass
+		return
+
+	def write(self, data):
+		self.next_chunk.append(data)
+		self.next_size += len(data)
+		if self.next_size >= self.chunk_size:
+			self.flush()
+		return
+
+	def flush(self):
+		if self.next_size > 0:
+			self.chunks.put(b''.join(self.next_chunk))
+			self.next_chunk = []
+			self.next_size = 0
+		return
+
+	def kill(self):
+		self.rsync.kill()
+		return
+
+	# end of the list, wait for rsync to finish. Returns standard output and error as close
+	# as possible to check_rsync_output, raises RsyncError if rsync failed
+	def close(self):
+		self.flush()
+		self.chunks.put(None)
+		for t in self.threads:
+			t.join()
+		self.rsync.stdout.close()
+		self.rsync.stderr.close()
+		self.rsync.wait()
+		err = self.output.stderr()
+		if self.rsync.returncode != 0:
+			raise RsyncError('rsync process terminated with returncode %d' % self.rsync.returncode, err)
+		if self.write_error is not None:
+			raise RsyncError('writing the file list to rsync failed: %s' % str(self.write_error), err)
+		_print_rsync_stderr(err)
+		return (self.output.stdout(), err)
+
+# True if args has rsync filter rules, as given with -f or --filter, e.g. -f+ */ or
+# --filter=- /a/cache/
+def has_filter_rules(args):
+	return any(not isinstance(a, bytes) and a.startswith(('-f', '--filter')) for a in args)
+
 def basic_rsync_cmd():
 	return [rsync_cmd] + rsync_copts
@@ -0,0 +1,334 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Multi threaded alternative to the rsync dry run in item_list.generate_list. Source and
+# destination are walked by a pool of threads, one directory per task, so the scan can take
+# advantage of the parallelism of the storage. The output is the same as generate_list
+
+import os
+import random
+import stat
+import sys
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Thread, Lock
+
+from .item_list import file_symbol, directory_symbol, new_file_symbol, read_list_batches
+from .rsync import has_filter_rules
+from . import default_buffer_size
+
+_links_opts = ('-l', '--links', '-a', '--archive')
+_times_opts = ('--times', '-a', '--archive')
+_perms_opts = ('--perms', '-a', '--archive')
+_owner_opts = ('-o', '--owner', '-a', '--archive')
+_group_opts = ('-g', '--group', '-a', '--archive')
+
+def _scandir(path):
+	entries = {}
+	with os.scandir(path) as it:
+		for entry in it:
+			entries[entry.name] = entry
+	return entries
+
+class _DirScan():
+
+	def __init__(self):
+		self.items = []
+		self.deletes = []
+		self.subdirs = []
+		self.delete_dirs = []
+		self.records = []
+
+# index is an index.MetadataIndex or None. If given, a directory whose modification time is
+# the same in the index, in the source and in the destination has not changed its list of
+# entries since the last run, so it is not listed again: its entries are taken from the
+# index and only the source ones are checked, the destination ones are assumed to be as we
+# left them. A fraction validate of these directories is scanned fully anyway, if any
+# difference is found the index is not trusted anymore for the rest of the scan
+class TreeScanner():
+
+	def __init__(self, rsync_opts, source, dest, item_func, delete_func, nthreads, index = None, validate = 0.01):
+		if has_filter_rules(rsync_opts):
+			raise ValueError('filters are not supported by the native scanner, use the rsync scanner instead')
+		self.source = source.rstrip(b'/')
+		self.dest = dest.rstrip(b'/')
+		self.item_func = item_func
+		self.delete_func = delete_func
+		self.nthreads = nthreads
+		self.delete = '--delete' in rsync_opts
+		self.links = any(opt in rsync_opts for opt in _links_opts)
+		self.times = any(opt in rsync_opts for opt in _times_opts)
+		self.perms = any(opt in rsync_opts for opt in _perms_opts)
+		# as rsync, only the super user can change the owner
+		self.owner = any(opt in rsync_opts for opt in _owner_opts) and os.geteuid() == 0
+		self.group = any(opt in rsync_opts for opt in _group_opts)
+		self.task_queue = Queue()
+		self.lock = Lock()
+		self.pending = 0
+		self.errors = []
+		self.index = index
+		self.validate = validate
+		# without --times directory modification times in dest mean nothing
+		self.use_index = index is not None and self.times
+		self.index_hits = 0
+
+	def _submit(self, task):
+		with self.lock:
+			self.pending += 1
+		self.task_queue.put(task)
+		return
+
+	def _task_done(self):
+		with self.lock:
+			self.pending -= 1
+			finished = self.pending == 0
+		if finished:
+			for i in range(self.nthreads):
+				self.task_queue.put(None)
+		return
+
+	# the attributes rsync would change even if the data is up to date
+	def _attrs_changed(self, src_st, dst_st):
+		return (self.perms and stat.S_IMODE(src_st.st_mode) != stat.S_IMODE(dst_st.st_mode)) or \
+			(self.owner and src_st.st_uid != dst_st.st_uid) or \
+			(self.group and src_st.st_gid != dst_st.st_gid)
+
+	def _changed(self, src_st, dst_st, is_dir):
+		if dst_st is None:
+			return True
+		if is_dir:
+			return (self.times and int(src_st.st_mtime) != int(dst_st.st_mtime)) or self._attrs_changed(src_st, dst_st)
+		# rsync quick check: size and modification time
+		return src_st.st_size != dst_st.st_size or int(src_st.st_mtime) != int(dst_st.st_mtime) or \
+			self._attrs_changed(src_st, dst_st)
+
+	def _compare(self, result, prefix, name, src_st, dst_st):
+		result.records.append((name, src_st.st_mode, src_st.st_uid, src_st.st_gid, src_st.st_size, src_st.st_mtime_ns))
+		if stat.S_ISDIR(src_st.st_mode):
+			if self._changed(src_st, dst_st, True):
+				result.items.append((directory_symbol, src_st.st_size, prefix + name + b'/'))
+			result.subdirs.append(prefix + name)
+		elif stat.S_ISREG(src_st.st_mode) or (self.links and stat.S_ISLNK(src_st.st_mode)):
+			if dst_st is None and stat.S_ISREG(src_st.st_mode):
+				result.items.append((new_file_symbol, src_st.st_size, prefix + name))
+			elif self._changed(src_st, dst_st, False):
+				result.items.append((file_symbol, src_st.st_size, prefix + name))
+		else:
+			print('skipping non-regular file "%s"' % os.fsdecode(prefix + name), file = sys.stderr)
+		return
+
+	def _full_scan(self, src_dir, dst_dir, prefix):
+		result = _DirScan()
+		src_entries = _scandir(src_dir)
+		try:
+			dst_entries = _scandir(dst_dir)
+		except (FileNotFoundError, NotADirectoryError):
+			dst_entries = {}
+		for name, entry in src_entries.items():
+			dst_entry = dst_entries.get(name)
+			dst_st = dst_entry.stat(follow_symlinks = False) if dst_entry is not None else None
+			self._compare(result, prefix, name, entry.stat(follow_symlinks = False), dst_st)
+		if self.delete:
+			for name, entry in dst_entries.items():
+				if name in src_entries:
+					continue
+				if entry.is_dir(follow_symlinks = False):
+					result.delete_dirs.append(prefix + name)
+				result.deletes.append(prefix + name)
+		return result
+
+	# returns None if the directory can't be trusted to be unchanged
+	def _cached_scan(self, rel, src_dir, dst_dir, prefix, src_dir_st):
+		cached = self.index.lookup(rel)
+		if cached is None or cached[0] != src_dir_st.st_mtime_ns:
+			return None
+		try:
+			dst_dir_st = os.lstat(dst_dir)
+		except FileNotFoundError:
+			return None
+		if int(dst_dir_st.st_mtime) != int(src_dir_st.st_mtime):
+			return None
+		result = _DirScan()
+		for name, dst_st in cached[1].items():
+			try:
+				src_st = os.lstat(src_dir + b'/' + name)
+			except FileNotFoundError:
+				# changed while we are looking at it
+				return None
+			self._compare(result, prefix, name, src_st, dst_st)
+		return result
+
+	def _scan_dir(self, rel):
+		src_dir = self.source + b'/' + rel if rel != b'' else self.source
+		dst_dir = self.dest + b'/' + rel if rel != b'' else self.dest
+		prefix = rel + b'/' if rel != b'' else b''
+		src_dir_st = os.lstat(src_dir)
+		result = None
+		if self.use_index:
+			result = self._cached_scan(rel, src_dir, dst_dir, prefix, src_dir_st)
+			if result is not None and random.random() < self.validate:
+				full = self._full_scan(src_dir, dst_dir, prefix)
+				if sorted(full.items) != sorted(result.items) or sorted(full.deletes) != sorted(result.deletes):
+					print('WARNING: the index does not match the content of %s, not using it anymore. ' \
+						'Directory modification times might not be reliable on this file system' % os.fsdecode(src_dir),
+						file = sys.stderr)
+					self.use_index = False
+				result = full
+			elif result is not None:
+				self.index_hits += 1
+		if result is None:
+			result = self._full_scan(src_dir, dst_dir, prefix)
+		if self.index is not None:
+			self.index.record(rel, src_dir_st.st_mtime_ns, result.records)
+		for subdir in result.subdirs:
+			self._submit((subdir, False))
+		for subdir in result.delete_dirs:
+			self._submit((subdir, True))
+		self._emit(result.items, result.deletes)
+		return
+
+	# everything below an extraneous directory has to go as well
+	def _scan_delete(self, rel):
+		deletes = []
+		for name, entry in _scandir(self.dest + b'/' + rel).items():
+			if entry.is_dir(follow_symlinks = False):
+				self._submit((rel + b'/' + name, True))
+			deletes.append(rel + b'/' + name)
+		self._emit([], deletes)
+		return
+
+	def _emit(self, items, deletes):
+		with self.lock:
+			for is_dir, size, path in items:
+				self.item_func(is_dir, str(size).encode(), path)
+			for path in deletes:
+				self.delete_func(path)
+		return
+
+	def _worker(self):
+		while True:
+			task = self.task_queue.get()
+			if task is None:
+				break
+			rel, delete_only = task
+			try:
+				if delete_only:
+					self._scan_delete(rel)
+				else:
+					self._scan_dir(rel)
+			except Exception as e:
+				self.errors.append(e)
+			finally:
+				self._task_done()
+		return
+
+	# the transfer root is not an entry of any scanned directory, compare it here. rsync
+	# calls it ./
+	def _scan_root(self):
+		src_st = os.lstat(self.source if self.source != b'' else b'/')
+		try:
+			dst_st = os.lstat(self.dest if self.dest != b'' else b'/')
+		except FileNotFoundError:
+			dst_st = None
+		if self._changed(src_st, dst_st, True):
+			self._emit([(directory_symbol, src_st.st_size, b'./')], [])
+		return
+
+	def scan(self):
+		self._scan_root()
+		self._submit((b'', False))
+		threads = [Thread(name = 'Scanner thread number %d' % i, target = self._worker) for i in range(self.nthreads)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		if len(self.errors) > 0:
+			for e in self.errors[1:]:
+				print('Error while scanning: %s' % str(e), file = sys.stderr)
+			raise self.errors[0]
+		if self.index_hits > 0:
+			print('%d unchanged directories not listed thanks to the index' % self.index_hits)
+		return
+
+def scan_trees_stream(rsync_opts, source, dest, item_func, delete_func, nthreads = 4, index = None, validate = 0.01):
+	TreeScanner(rsync_opts, source, dest, item_func, delete_func, nthreads, index, validate).scan()
+	return
+
+# drop in replacement for item_list.generate_list
+def scan_trees(rsync_opts, source, dest, list_path, delete_path, nthreads = 4, index = None, validate = 0.01):
+	with open(list_path, 'wb', buffering = default_buffer_size) as list_fd, \
+			open(delete_path, 'wb', buffering = default_buffer_size) as delete_fd:
+		scan_trees_stream(
+				rsync_opts,
+				source,
+				dest,
+				lambda isdir, size, path: list_fd.write(isdir + b' ' + size + b' ' + path + b'\0'),
+				lambda path: delete_fd.write(path + b'\0'),
+				nthreads,
+				index,
+				validate
+		)
+	return
+
+stat_chunk_size = 256
+
+def _stat_paths(source, paths):
+	items = []
+	for path in paths:
+		try:
+			st = os.lstat(os.path.join(source, path.lstrip(b'/')))
+		except OSError as e:
+			# leave it to rsync to report the error, as without stat
+			print('WARNING: cannot stat %s: %s' % (os.fsdecode(path), e.strerror), file = sys.stderr)
+			items.append((file_symbol, b'0', path))
+			continue
+		kind = directory_symbol if stat.S_ISDIR(st.st_mode) else file_symbol
+		items.append((kind, str(st.st_size).encode(), path))
+	return items
+
+def _emit_stat_batch(future, item_func):
+	for is_dir, size, path in future.result():
+		item_func(is_dir, size, path)
+	return
+
+def _stat_records(records, sep, source, executor, pending, window, item_func):
+	if sep == b'\n':
+		# rsync accepts CR+LF line endings too
+		records = [r[:-1] if r.endswith(b'\r') else r for r in records]
+	records = [r for r in records if r != b'']
+	for i in range(0, len(records), stat_chunk_size):
+		pending.append(executor.submit(_stat_paths, source, records[i:i + stat_chunk_size]))
+		if len(pending) >= window:
+			_emit_stat_batch(pending.popleft(), item_func)
+	return
+
+# turn a plain list of paths (relative to source, as for rsync --files-from) into items
+# for item_func(is_dir, size, path), in list order. Empty lines are skipped. The entries are stat-ed by nthreads
+# threads in chunks of stat_chunk_size, at most a few chunks per thread are kept in memory
+def stat_list_stream(list_path, sep, source, nthreads, item_func):
+	pending = deque()
+	with ThreadPoolExecutor(max_workers = nthreads, thread_name_prefix = 'stat_worker_') as executor:
+		read_list_batches(list_path, sep, _stat_records, (sep, source, executor, pending, 4 * nthreads, item_func))
+		while len(pending) > 0:
+			_emit_stat_batch(pending.popleft(), item_func)
+	return
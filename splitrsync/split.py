@@ -19,14 +19,26 @@
 #                                                                            #
 ##############################################################################
 
+from collections import deque
 from copy import deepcopy
-from .item_list import dump_list, read_list_process_line
-from .item_list import directory_symbol
+from functools import partial
+from tempfile import mkdtemp
+from .item_list import dump_list, read_list_process_line, read_list_batches, list_ranges, is_regular_list
+from .item_list import directory_symbol, new_file_symbol
+from .profiling import profiled
 from . import default_buffer_size
 
+import heapq
 import io
+import multiprocessing
+import os
 
 _min_corrected_size = 4096
+default_batch_files = 10000
+default_file_cost = 64 * 1024
+default_group_bytes = 10 * 1024**3 # 10GB
+default_group_files = 10000
+parallel_range_size = 64 * 1024**2 # 64MB
 
 def _static_vars(**kwargs):
 	def decorate(func):
@@ -35,6 +47,12 @@ def _static_vars(**kwargs):
 		return func
 	return decorate
 
+def _parse_size(size):
+	try:
+		return int(size, 10)
+	except ValueError as e:
+		raise RuntimeError('Invalid integer found for size while processing input file: %s' % str(e))
+
 def _find_smaller(size):
 	smaller = 0
 	for i in range(len(size)):
@@ -53,10 +71,7 @@ def split_rr(**kwargs):
 @_static_vars(smaller = 0, sizes = [])
 def split_size(**kwargs):
 	n = kwargs['n']
-	try:
-		size = int(kwargs['size'], 10)
-	except ValueError as e:
-		raise RuntimeError('Invalid integer found for size while processing input file: %s' % str(e))
+	size = _parse_size(kwargs['size'])
 	if split_size.sizes == []:
 		split_size.sizes = [0] * n
 	ret = split_size.smaller
@@ -65,37 +80,458 @@ def split_size(**kwargs):
 	split_size.smaller = _find_smaller(split_size.sizes)
 	return ret
 
+# batch versions of the split functions: sizes are integers, one index is returned for each
+# file. The result is the same as calling the split function once per file
+def _split_rr_batch(n, sizes, paths):
+	first = split_rr.next_index
+	split_rr.next_index = (first + len(sizes)) % n
+	return [(first + i) % n for i in range(len(sizes))]
+
+def _split_size_batch(n, sizes, paths):
+	if split_size.sizes == []:
+		split_size.sizes = [0] * n
+	list_sizes = split_size.sizes
+	smaller = split_size.smaller
+	ret = []
+	for size in sizes:
+		ret.append(smaller)
+		list_sizes[smaller] += size if size >= _min_corrected_size else _min_corrected_size
+		smaller = _find_smaller(list_sizes)
+	split_size.smaller = smaller
+	return ret
+
+split_rr.split_batch = _split_rr_batch
+split_size.split_batch = _split_size_batch
+
+# longest processing time first bin packing: every file goes to the list with the lowest cost
+# so far, found at the top of a min heap. The cost of a file is its size plus a fixed per file
+# overhead, for small files the latency of each file dominates over the amount of data.
+# With presort = True read_split_dump sorts the files by size, largest first, before
+# splitting them. This needs to keep the whole file list in memory, but gives a much better
+# balance when big files are found late in the list
+class LPTSplit():
+
+	def __init__(self, file_cost = default_file_cost, presort = False):
+		self.file_cost = file_cost
+		self.presort = presort
+		self.heap = None
+
+	def _assign(self, n, size):
+		if self.heap is None:
+			self.heap = [(0, i) for i in range(n)]
+		cost, index = self.heap[0]
+		heapq.heapreplace(self.heap, (cost + size + self.file_cost, index))
+		return index
+
+	def __call__(self, **kwargs):
+		return self._assign(kwargs['n'], _parse_size(kwargs['size']))
+
+	def split_batch(self, n, sizes, paths):
+		return [self._assign(n, size) for size in sizes]
+
+# keep the files of the same directory in the same list, so the rsync processes don't
+# compete for the same directory on the file system. Files are processed in list order: as
+# long as they belong to the current group they go to the same list, a new group goes to the
+# list with the lowest cost (size plus file_cost per file, as in LPTSplit). A group is
+# closed when it reaches max_bytes or max_files, so a huge directory is still split.
+# With subtrees = True a group is a whole subtree instead of a single directory
+class DirAffinitySplit():
+
+	def __init__(self, max_bytes = default_group_bytes, max_files = default_group_files, file_cost = default_file_cost,
+			subtrees = False):
+		self.max_bytes = max_bytes
+		self.max_files = max_files
+		self.file_cost = file_cost
+		self.subtrees = subtrees
+		self.heap = None
+		self.costs = None
+		self.group = None
+		self.index = None
+		self.group_bytes = 0
+		self.group_files = 0
+
+	def _in_group(self, parent):
+		if self.group is None:
+			return False
+		if parent == self.group:
+			return True
+		return self.subtrees and parent.startswith(self.group + b'/')
+
+	def _close_group(self):
+		if self.index is not None:
+			heapq.heappush(self.heap, (self.costs[self.index], self.index))
+		self.group = None
+		self.index = None
+		return
+
+	def __call__(self, **kwargs):
+		return self._assign(kwargs['n'], _parse_size(kwargs['size']), kwargs['path'])
+
+	def split_batch(self, n, sizes, paths):
+		return [self._assign(n, size, path) for size, path in zip(sizes, paths)]
+
+	def _assign(self, n, size, path):
+		if self.heap is None:
+			self.heap = [(0, i) for i in range(n)]
+			self.costs = [0] * n
+		parent = path.rstrip(b'/').rpartition(b'/')[0]
+		if not self._in_group(parent) or self.group_bytes >= self.max_bytes or self.group_files >= self.max_files:
+			group = parent if not self._in_group(parent) else self.group
+			self._close_group()
+			self.group = group
+			self.index = heapq.heappop(self.heap)[1]
+			self.group_bytes = 0
+			self.group_files = 0
+		self.costs[self.index] += size + self.file_cost
+		self.group_bytes += size
+		self.group_files += 1
+		return self.index
+
 # default split function
 default_split_list = split_rr
 
-def _process_item(raw_line, split_fd_list, split_func, dir_list):
+def _split_item_line(raw_line):
 	try:
 		is_dir, size, path = raw_line.split(b' ', 2)
 	except ValueError:
 		# TODO requires some further enhancement to be cough later
 		raise ValueError('Input file list contains malformed line: %s' % repr(raw_line))
+	return is_dir, size, path
+
+# large and small are None or a (threshold, fd) pair: files of at least large[0] bytes and
+# new files (see item_list.new_file_symbol) below small[0] bytes are written to the fd
+# instead of being assigned to one of the lists. Returns True if the item was set aside
+def _set_aside(is_dir, size, path, large, small):
+	if large is not None and _parse_size(size) >= large[0]:
+		large[1].write(path + b'\0')
+		return True
+	if small is not None and is_dir == new_file_symbol and _parse_size(size) < small[0]:
+		small[1].write(path + b'\0')
+		return True
+	return False
+
+def _route_item(size, path, split_fd_list, split_func, stats):
+	index = split_func(n = len(split_fd_list), size = size, path = path)
+	split_fd_list[index].write(path + b'\0')
+	stats[index][0] += 1
+	stats[index][1] += _parse_size(size)
+	return
+
+def _process_item(is_dir, size, path, split_fd_list, split_func, dir_list, stats, large, small):
+	if is_dir == directory_symbol:
+		dir_list.write(path + b'\0')
+	elif not _set_aside(is_dir, size, path, large, small):
+		_route_item(size, path, split_fd_list, split_func, stats)
+	return
+
+def _collect_item(is_dir, size, path, items, dir_list, large, small):
 	if is_dir == directory_symbol:
 		dir_list.write(path + b'\0')
+	elif not _set_aside(is_dir, size, path, large, small):
+		items.append((_parse_size(size), size, path))
+	return
+
+# split the items produced by feed_func between the file like objects in split_fd_list.
+# feed_func is called with a function taking (is_dir, size, path) as argument and calls it
+# for every item. Directories are written to dir_list. stats as in read_split_dump, large
+# and small as in _set_aside
+def split_items(feed_func, split_fd_list, split_func, dir_list, stats = None, large = None, small = None):
+	if stats is None:
+		stats = []
+	stats[:] = [[0, 0] for i in range(len(split_fd_list))]
+	if getattr(split_func, 'presort', False):
+		items = []
+		feed_func(lambda is_dir, size, path: _collect_item(is_dir, size, path, items, dir_list, large, small))
+		items.sort(key = lambda item: item[0], reverse = True)
+		for int_size, size, path in items:
+			_route_item(size, path, split_fd_list, split_func, stats)
+		del items
 	else:
-		index = split_func(n = len(split_fd_list), size = size)
-		split_fd_list[index].write(path + b'\0')
+		feed_func(lambda is_dir, size, path:
+				_process_item(is_dir, size, path, split_fd_list, split_func, dir_list, stats, large, small))
+	return
+
+def split_batch(split_func, n, sizes, paths):
+	batch_func = getattr(split_func, 'split_batch', None)
+	if batch_func is not None:
+		return batch_func(n, sizes, paths)
+	return [split_func(n = n, size = b'%d' % size, path = path) for size, path in zip(sizes, paths)]
+
+_dir_kind = directory_symbol[0]
+_new_kind = new_file_symbol[0]
+_file_kind = b'F'[0]
+_kinds = {directory_symbol: _dir_kind, new_file_symbol: _new_kind}
+
+# parse a list of raw item lines into a compact batch: a kind for each item (directory, new
+# file or any other file), the sizes as integers and the paths. Cheap to send to another
+# process as the paths are joined in a single bytes object
+def parse_item_records(records):
+	kinds = bytearray(len(records))
+	sizes = []
+	paths = []
+	for i in range(len(records)):
+		try:
+			is_dir, size, path = records[i].split(b' ', 2)
+		except ValueError:
+			# raises the same error as per line processing
+			_split_item_line(records[i])
+		kinds[i] = _kinds.get(is_dir, _file_kind)
+		sizes.append(_parse_size(size))
+		paths.append(path)
+	return bytes(kinds), sizes, b'\0'.join(paths)
+
+# same as calling _process_item for every item in the batch, each list gets a single write
+def _route_batch(batch, split_fd_list, split_func, dir_list, stats, large, small):
+	kinds, sizes, paths = batch
+	if len(kinds) == 0:
+		return
+	paths = paths.split(b'\0')
+	dirs = []
+	large_out = []
+	small_out = []
+	route_sizes = []
+	route_paths = []
+	for kind, size, path in zip(kinds, sizes, paths):
+		if kind == _dir_kind:
+			dirs.append(path)
+		elif large is not None and size >= large[0]:
+			large_out.append(path)
+		elif small is not None and kind == _new_kind and size < small[0]:
+			small_out.append(path)
+		else:
+			route_sizes.append(size)
+			route_paths.append(path)
+	n = len(split_fd_list)
+	outs = [[] for i in range(n)]
+	for index, size, path in zip(split_batch(split_func, n, route_sizes, route_paths), route_sizes, route_paths):
+		outs[index].append(path)
+		stats[index][0] += 1
+		stats[index][1] += size
+	for fd, out in ((dir_list, dirs), (large[1] if large is not None else None, large_out),
+			(small[1] if small is not None else None, small_out)):
+		if len(out) > 0:
+			fd.write(b'\0'.join(out) + b'\0')
+	for i in range(n):
+		if len(outs[i]) > 0:
+			split_fd_list[i].write(b'\0'.join(outs[i]) + b'\0')
 	return
 
-def read_split_dump(file_list_path, sep, n, split_func, tmpdir, name = 'list-%s'):
+def _parse_range(list_path, sep, start, end):
+	batches = []
+	read_list_batches(list_path, sep, lambda records: batches.append(parse_item_records(records)), (), default_buffer_size,
+			start, end)
+	kinds = b''.join(b[0] for b in batches)
+	sizes = [size for b in batches for size in b[1]]
+	paths = b'\0'.join(b[2] for b in batches if len(b[0]) > 0)
+	return kinds, sizes, paths
+
+# parse the list in byte ranges of about range_size bytes with nprocs processes, batch_func
+# is called in list order with the parsed batch of each range. At most 2 * nprocs ranges are
+# parsed ahead of the consumer. A list which is not a regular file, e.g. a pipe, can't be
+# split in ranges and is parsed by this process
+def parse_list_parallel(list_path, sep, nprocs, batch_func, range_size = parallel_range_size):
+	if not is_regular_list(list_path):
+		read_list_batches(list_path, sep, lambda records: batch_func(parse_item_records(records)))
+		return
+	nranges = max(nprocs, os.path.getsize(list_path) // range_size + 1)
+	ranges = list_ranges(list_path, sep, nranges)
+	with multiprocessing.Pool(nprocs) as pool:
+		pending = deque()
+		for start, end in ranges:
+			pending.append(pool.apply_async(_parse_range, (list_path, sep, start, end)))
+			if len(pending) >= 2 * nprocs:
+				batch_func(pending.popleft().get())
+		while len(pending) > 0:
+			batch_func(pending.popleft().get())
+	return
+
+# feed function for split_items reading an item list file
+def feed_item_list(file_list_path, sep, item_func):
+	read_list_process_line(file_list_path, sep, lambda raw_line: item_func(*_split_item_line(raw_line)), ())
+	return
+
+# stats, if given, is filled with a [files, bytes] pair for each list. If large_size is
+# given files of at least large_size bytes are written to large_list_path instead, if
+# small_size is given new files below small_size bytes are written to small_list_path.
+# The list is read in batches, parsed by parse_processes processes if more than one.
+# If feed_func is given the items come from it instead of file_list_path, see split_items
+def read_split_dump(file_list_path, sep, n, split_func, tmpdir, name = 'list-%s', stats = None,
+		large_size = None, large_list_path = None, small_size = None, small_list_path = None, parse_processes = 1,
+		feed_func = None):
 	split_list_files = []
 	split_fd_list = []
+	large = None
+	if large_size is not None:
+		large = (large_size, open(large_list_path, 'wb', buffering = default_buffer_size))
+	small = None
+	if small_size is not None:
+		small = (small_size, open(small_list_path, 'wb', buffering = default_buffer_size))
 	dir_list_path = tmpdir + '/' + name % 'dir'
 	dir_list = open(dir_list_path, 'wb')
 	for i in range(n):
 		next_file = tmpdir + '/' + name % str(i)
 		split_list_files.append(next_file)
 		split_fd_list.append(open(next_file, 'wb', buffering = default_buffer_size))
-	read_list_process_line(file_list_path, sep, _process_item, (split_fd_list, split_func, dir_list))
+	with profiled('split'):
+		if feed_func is not None:
+			split_items(feed_func, split_fd_list, split_func, dir_list, stats, large, small)
+		elif getattr(split_func, 'presort', False):
+			split_items(partial(feed_item_list, file_list_path, sep), split_fd_list, split_func, dir_list, stats, large, small)
+		else:
+			if stats is None:
+				stats = []
+			stats[:] = [[0, 0] for i in range(n)]
+			route_args = (split_fd_list, split_func, dir_list, stats, large, small)
+			if parse_processes > 1:
+				parse_list_parallel(file_list_path, sep, parse_processes, lambda batch: _route_batch(batch, *route_args))
+			else:
+				read_list_batches(file_list_path, sep, lambda records: _route_batch(parse_item_records(records), *route_args))
 	for fd in split_fd_list:
 		fd.close()
+	if large is not None:
+		large[1].close()
+	if small is not None:
+		small[1].close()
 	dir_list.close()
 	return split_list_files, dir_list_path
 
+def print_split_stats(stats):
+	if len(stats) == 0:
+		return
+	for i in range(len(stats)):
+		print('List %d: %d files, %d bytes' % (i, stats[i][0], stats[i][1]))
+	sizes = [s[1] for s in stats]
+	mean = sum(sizes) / len(sizes)
+	if mean > 0:
+		print('Size imbalance: largest list is %.1f%% above the average' % ((max(sizes) / mean - 1) * 100))
+	return
+
+def _dir_key(path, depth):
+	components = path.strip(b'/').split(b'/')
+	if path.strip(b'/') in (b'', b'.') or len(components) < depth:
+		return None
+	return b'/'.join(components[:depth])
+
+def _count_dir(path, counts, depth):
+	key = _dir_key(path, depth)
+	if key is not None:
+		counts[key] = counts.get(key, 0) + 1
+	return
+
+def _route_dir(path, top_fd, split_fd_list, assignment, depth):
+	key = _dir_key(path, depth)
+	if key is None:
+		top_fd.write(path + b'\0')
+	else:
+		split_fd_list[assignment[key]].write(path + b'\0')
+	return
+
+# split the directory list in disjoint subtrees. Directories are grouped by their first depth
+# path components and the groups are distributed across n lists by number of directories.
+# Directories shallower than depth, which are the parents shared by all the groups, go to a
+# separate list which has to be synced before and after the others. Returns the path of this
+# list and the paths of the n subtree lists
+def split_dir_tree(dir_list_path, n, depth, tmpdir, name = 'dirs-%s'):
+	counts = {}
+	read_list_process_line(dir_list_path, b'\0', _count_dir, (counts, depth))
+	heap = [(0, i) for i in range(n)]
+	assignment = {}
+	for key in sorted(counts, key = lambda k: counts[k], reverse = True):
+		cost, index = heap[0]
+		heapq.heapreplace(heap, (cost + counts[key], index))
+		assignment[key] = index
+	top_list_path = tmpdir + '/' + name % 'top'
+	split_list_files = [tmpdir + '/' + name % str(i) for i in range(n)]
+	split_fd_list = [open(path, 'wb', buffering = default_buffer_size) for path in split_list_files]
+	with open(top_list_path, 'wb') as top_fd:
+		read_list_process_line(dir_list_path, b'\0', _route_dir, (top_fd, split_fd_list, assignment, depth))
+	for fd in split_fd_list:
+		fd.close()
+	return top_list_path, split_list_files
+
+# same routing as read_split_dump, but each of the n lists is cut in batches of at most
+# max_files files and max_bytes bytes (None for no limit). As soon as a batch is complete
+# its file is closed and the path is handed to batch_func(path, files, bytes), so a
+# consumer can start working on it while more items are still coming
+class SplitBatchDumper():
+
+	def __init__(self, n, split_func, tmpdir, batch_func, max_files = default_batch_files, max_bytes = None,
+			large_size = None, small_size = None, name = 'batch-%s'):
+		self.n = n
+		self.split_func = split_func if split_func is not None else default_split_list
+		self.tmpdir = tmpdir
+		self.batch_func = batch_func
+		self.max_files = max_files
+		self.max_bytes = max_bytes
+		self.name = name
+		self.batch_count = 0
+		self.batch_list = []
+		self.dir_list_path = tmpdir + '/' + name % 'dir'
+		self.dir_list = open(self.dir_list_path, 'wb', buffering = default_buffer_size)
+		self.lanes = [None] * n
+		self.lane_files = [0] * n
+		self.lane_bytes = [0] * n
+		self.large_list_path = None
+		self.large = None
+		if large_size is not None:
+			self.large_list_path = tmpdir + '/' + name % 'large'
+			self.large = (large_size, open(self.large_list_path, 'wb', buffering = default_buffer_size))
+		self.small_list_path = None
+		self.small = None
+		if small_size is not None:
+			self.small_list_path = tmpdir + '/' + name % 'small'
+			self.small = (small_size, open(self.small_list_path, 'wb', buffering = default_buffer_size))
+
+	def _open_batch(self, index):
+		next_file = self.tmpdir + '/' + self.name % str(self.batch_count)
+		self.batch_count += 1
+		self.lanes[index] = (next_file, open(next_file, 'wb', buffering = default_buffer_size))
+		self.lane_files[index] = 0
+		self.lane_bytes[index] = 0
+		return
+
+	def _close_batch(self, index):
+		path, fd = self.lanes[index]
+		fd.close()
+		self.lanes[index] = None
+		self.batch_list.append(path)
+		self.batch_func(path, self.lane_files[index], self.lane_bytes[index])
+		return
+
+	def add_item(self, is_dir, size, path):
+		if is_dir == directory_symbol:
+			self.dir_list.write(path + b'\0')
+			return
+		if _set_aside(is_dir, size, path, self.large, self.small):
+			return
+		index = self.split_func(n = self.n, size = size, path = path)
+		if self.lanes[index] is None:
+			self._open_batch(index)
+		self.lanes[index][1].write(path + b'\0')
+		size = _parse_size(size)
+		self.lane_files[index] += 1
+		self.lane_bytes[index] += size
+		if self.lane_files[index] >= self.max_files or \
+				(self.max_bytes is not None and self.lane_bytes[index] >= self.max_bytes):
+			self._close_batch(index)
+		return
+
+	def process_line(self, raw_line):
+		is_dir, size, path = _split_item_line(raw_line)
+		self.add_item(is_dir, size, path)
+		return
+
+	def finish(self):
+		for i in range(self.n):
+			if self.lanes[i] is not None:
+				self._close_batch(i)
+		self.dir_list.close()
+		if self.large is not None:
+			self.large[1].close()
+		if self.small is not None:
+			self.small[1].close()
+		return
+
 def dump_split_list(item_split_list, name = 'list-%d', path = None):
 	dir_path = path
 	if path is None:
@@ -0,0 +1,93 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Persistent state of a run, to resume it after an interruption. The generated lists are
+# kept in the run directory together with a journal of the completed steps (list
+# generation, splitting, directory tree, each worker list or batch). A restarted run with
+# the same options skips everything found in the journal
+
+import json
+import os
+import shutil
+
+from threading import Lock
+
+run_dir_name = 'run'
+config_name = 'state.json'
+journal_name = 'journal'
+
+class StateError(Exception):
+	pass
+
+class RunState():
+
+	def __init__(self, state_dir, config):
+		self.state_dir = state_dir
+		self.run_dir = os.path.join(state_dir, run_dir_name)
+		self.config = config
+		self.done = set()
+		self.lock = Lock()
+		self.journal = None
+
+	# rescan = True throws away whatever was left by a previous run
+	def load(self, rescan = False):
+		if rescan and os.path.isdir(self.run_dir):
+			shutil.rmtree(self.run_dir)
+		os.makedirs(self.run_dir, exist_ok = True)
+		config_path = os.path.join(self.run_dir, config_name)
+		journal_path = os.path.join(self.run_dir, journal_name)
+		if os.path.exists(config_path):
+			with open(config_path) as f:
+				old_config = json.load(f)
+			if old_config != self.config:
+				raise StateError(
+						'The interrupted run found in %s was started with different options. ' \
+						'Use the same options to resume it or use --rescan to start from scratch' % self.run_dir
+				)
+			if os.path.exists(journal_path):
+				with open(journal_path) as f:
+					self.done = set(line.rstrip('\n') for line in f if line.endswith('\n'))
+			if len(self.done) > 0:
+				print('Resuming interrupted run, %d completed steps found in %s' % (len(self.done), self.run_dir))
+		else:
+			with open(config_path, 'w') as f:
+				json.dump(self.config, f, indent = 1)
+		self.journal = open(journal_path, 'a')
+		return
+
+	def is_done(self, step):
+		return step in self.done
+
+	def mark_done(self, step):
+		with self.lock:
+			self.done.add(step)
+			self.journal.write(step + '\n')
+			self.journal.flush()
+			os.fsync(self.journal.fileno())
+		return
+
+	# the run completed, nothing to resume
+	def clear(self):
+		if self.journal is not None:
+			self.journal.close()
+			self.journal = None
+		shutil.rmtree(self.run_dir)
+		return
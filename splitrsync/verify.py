@@ -0,0 +1,216 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Check the copied files after the transfer, without rsync -c hashing everything in a
+# single process: the files in the split lists are compared by a pool of threads. hashlib
+# releases the GIL while hashing large buffers, so threads are enough to use many cores
+
+import hashlib
+import json
+import os
+import random
+import stat
+import sys
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+
+from .item_list import read_list_batches
+
+verify_modes = ['full', 'sample', 'headtail']
+default_algorithm = 'blake2b'
+default_block_size = 8 * 1024**2 # 8MB
+default_sample_percent = 1.0
+verify_chunk_size = 64
+
+class VerifyError(Exception):
+	pass
+
+# mode is one of:
+#  - full: every file is hashed entirely, in source and destination
+#  - sample: size and type of every file are compared, sample_percent percent of the files,
+#    chosen at random, are hashed entirely
+#  - headtail: the first and the last block_size bytes of every file are hashed
+class Verifier():
+
+	def __init__(self, source, dest, nthreads, mode = 'full', sample_percent = default_sample_percent,
+			block_size = default_block_size, algorithm = default_algorithm):
+		if mode not in verify_modes:
+			raise ValueError('unknown verify mode %s, valid modes are: %s' % (mode, ', '.join(verify_modes)))
+		self.source = source
+		self.dest = dest
+		self.nthreads = nthreads
+		self.mode = mode
+		self.sample_percent = sample_percent
+		self.block_size = block_size
+		self.algorithm = algorithm
+		self.random = random.Random()
+		self.buffers = local()
+		self.mismatches = []
+		self.files = 0
+		self.hashed_files = 0
+		self.hashed_bytes = 0
+		self.elapsed = 0
+
+	def _buffer(self):
+		buf = getattr(self.buffers, 'buf', None)
+		if buf is None:
+			buf = memoryview(bytearray(self.block_size))
+			self.buffers.buf = buf
+		return buf
+
+	def _hash_range(self, fd, h, offset, count):
+		buf = self._buffer()
+		while count > 0:
+			n = os.preadv(fd, [buf[:min(count, len(buf))]], offset)
+			if n == 0:
+				break
+			h.update(buf[:n])
+			offset += n
+			count -= n
+		return
+
+	# returns the digest and the number of bytes read
+	def _hash_file(self, path, size, whole):
+		h = hashlib.new(self.algorithm)
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			if whole or size <= 2 * self.block_size:
+				self._hash_range(fd, h, 0, size)
+				return h.digest(), size
+			self._hash_range(fd, h, 0, self.block_size)
+			self._hash_range(fd, h, size - self.block_size, self.block_size)
+		finally:
+			os.close(fd)
+		return h.digest(), 2 * self.block_size
+
+	# returns the reason of the mismatch, None if the files are the same, and the number of
+	# bytes hashed, None if not hashed
+	def _check(self, path, do_hash):
+		rel = path.lstrip(b'/')
+		src_path = os.path.join(self.source, rel)
+		dst_path = os.path.join(self.dest, rel)
+		src_st = os.lstat(src_path)
+		try:
+			dst_st = os.lstat(dst_path)
+		except FileNotFoundError:
+			return 'missing', None
+		if stat.S_IFMT(src_st.st_mode) != stat.S_IFMT(dst_st.st_mode):
+			return 'type', None
+		if stat.S_ISLNK(src_st.st_mode):
+			return 'link' if os.readlink(src_path) != os.readlink(dst_path) else None, None
+		if not stat.S_ISREG(src_st.st_mode):
+			return None, None
+		if src_st.st_size != dst_st.st_size:
+			return 'size', None
+		if not do_hash:
+			return None, None
+		whole = self.mode != 'headtail'
+		src_digest, read = self._hash_file(src_path, src_st.st_size, whole)
+		dst_digest, read = self._hash_file(dst_path, dst_st.st_size, whole)
+		return 'content' if src_digest != dst_digest else None, 2 * read
+
+	def _check_chunk(self, chunk):
+		mismatches = []
+		hashed_files = 0
+		hashed_bytes = 0
+		for path, do_hash in chunk:
+			try:
+				reason, read = self._check(path, do_hash)
+			except OSError as e:
+				reason, read = 'error: %s' % str(e), None
+			if reason is not None:
+				mismatches.append((path, reason))
+			if read is not None:
+				hashed_files += 1
+				hashed_bytes += read
+		return mismatches, hashed_files, hashed_bytes
+
+	def _collect(self, future):
+		mismatches, hashed_files, hashed_bytes = future.result()
+		self.mismatches += mismatches
+		self.hashed_files += hashed_files
+		self.hashed_bytes += hashed_bytes
+		return
+
+	def _submit_records(self, records, executor, pending):
+		chunk = []
+		for path in records:
+			do_hash = self.mode != 'sample' or self.random.random() * 100 < self.sample_percent
+			chunk.append((path, do_hash))
+			if len(chunk) >= verify_chunk_size:
+				pending.append(executor.submit(self._check_chunk, chunk))
+				chunk = []
+			if len(pending) >= 4 * self.nthreads:
+				self._collect(pending.popleft())
+		if len(chunk) > 0:
+			pending.append(executor.submit(self._check_chunk, chunk))
+		self.files += len(records)
+		return
+
+	# list_paths are \0 separated lists of paths relative to source and dest
+	def run(self, list_paths):
+		start = time.time()
+		pending = deque()
+		with ThreadPoolExecutor(max_workers = self.nthreads, thread_name_prefix = 'verify_worker_') as executor:
+			for list_path in list_paths:
+				read_list_batches(list_path, b'\0', self._submit_records, (executor, pending))
+			while len(pending) > 0:
+				self._collect(pending.popleft())
+		self.elapsed = time.time() - start
+		print('Verified %d files (%s mode), %d hashed, %.1f MB read in %.1f seconds (%.1f MB/s): %d mismatches' % (
+				self.files, self.mode, self.hashed_files, self.hashed_bytes / 1024**2, self.elapsed,
+				self.hashed_bytes / 1024**2 / self.elapsed if self.elapsed > 0 else 0, len(self.mismatches)))
+		return self.mismatches
+
+	def stats(self):
+		return {
+				'mode': self.mode,
+				'algorithm': self.algorithm,
+				'files': self.files,
+				'hashed_files': self.hashed_files,
+				'hashed_bytes': self.hashed_bytes,
+				'time': self.elapsed,
+				'mismatches': len(self.mismatches),
+		}
+
+	def dump_report(self, path):
+		report = self.stats()
+		report['mismatched_files'] = [{'path': os.fsdecode(p), 'reason': r} for p, r in self.mismatches]
+		with open(path, 'w') as f:
+			json.dump(report, f, indent = 1)
+		return
+
+	# \0 separated list of the mismatching files, to sync them again
+	def dump_mismatch_list(self, path):
+		with open(path, 'wb') as f:
+			for p, r in self.mismatches:
+				f.write(p + b'\0')
+		return
+
+def print_mismatches(mismatches, limit = 20):
+	for path, reason in mismatches[:limit]:
+		print('Mismatch (%s): %s' % (reason, os.fsdecode(path)), file = sys.stderr)
+	if len(mismatches) > limit:
+		print('... and %d more' % (len(mismatches) - limit), file = sys.stderr)
+	return
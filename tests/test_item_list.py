@@ -0,0 +1,111 @@
+# Copyright (C) 2020 Friedrich Miescher Institute for Biomedical Research
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+##############################################################################
+#                                                                            #
+# Author: Enrico Tagliavini          <enrico.tagliavini@fmi.ch>              #
+#                                                                            #
+##############################################################################
+
+# Lists given as pipes, e.g. --files-from <(...), have no size and can't be memory mapped,
+# they must be read the same as regular files
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from threading import Thread
+
+from splitrsync.item_list import read_list_batches
+from splitrsync.scanner import stat_list_stream
+from splitrsync.split import read_split_dump, split_rr
+
+items = b''.join(b'F %d a/f%d\n' % (i * 1000, i) for i in range(5000))
+
+def _write_fifo(path, data):
+	with open(path, 'wb') as f:
+		f.write(data)
+	return
+
+class PipeListTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		split_rr.next_index = 0
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def _fifo(self, data):
+		path = os.path.join(self.tmpdir, 'fifo')
+		os.mkfifo(path)
+		# the writer blocks until the list is opened, it must not keep a failed test hanging
+		writer = Thread(target = _write_fifo, args = (path, data), daemon = True)
+		writer.start()
+		return path, writer
+
+	def _regular(self, data):
+		path = os.path.join(self.tmpdir, 'regular')
+		with open(path, 'wb') as f:
+			f.write(data)
+		return path
+
+	def _read(self, path, sep = b'\n'):
+		records = []
+		read_list_batches(path, sep, records.extend, batch_size = 4096)
+		return records
+
+	def test_read_list_batches(self):
+		expected = self._read(self._regular(items))
+		path, writer = self._fifo(items)
+		self.assertEqual(self._read(path), expected)
+		writer.join(10)
+		self.assertEqual(len(expected), 5000)
+
+	def test_no_final_separator(self):
+		path, writer = self._fifo(items.rstrip(b'\n'))
+		self.assertEqual(len(self._read(path)), 5000)
+		writer.join(10)
+
+	def test_read_split_dump(self):
+		for parse_processes in (1, 2):
+			split_rr.next_index = 0
+			path, writer = self._fifo(items)
+			stats = []
+			lists, dir_list = read_split_dump(path, b'\n', 2, split_rr, self.tmpdir, stats = stats,
+					parse_processes = parse_processes)
+			writer.join(10)
+			os.unlink(path)
+			self.assertEqual(stats, [[2500, sum(range(0, 5000, 2)) * 1000], [2500, sum(range(1, 5000, 2)) * 1000]])
+			with open(lists[0], 'rb') as f:
+				self.assertEqual(f.read().split(b'\0')[:2], [b'a/f0', b'a/f2'])
+
+	def test_stat_list_stream(self):
+		source = os.path.join(self.tmpdir, 'source')
+		os.makedirs(os.path.join(source, 'a'))
+		paths = [b'a/f%d' % i for i in range(1000)]
+		for i, path in enumerate(paths):
+			with open(os.path.join(os.fsencode(source), path), 'wb') as f:
+				f.write(b'x' * i)
+		path, writer = self._fifo(b'a\n' + b'\n'.join(paths) + b'\n')
+		items = []
+		stat_list_stream(path, b'\n', os.fsencode(source), 4, lambda *item: items.append(item))
+		writer.join(10)
+		dir_size = b'%d' % os.lstat(os.path.join(source, 'a')).st_size
+		self.assertEqual(items, [(b'D', dir_size, b'a')] + [(b'F', b'%d' % i, p) for i, p in enumerate(paths)])
+
+if __name__ == '__main__':
+	unittest.main()